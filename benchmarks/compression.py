@@ -0,0 +1,52 @@
+"""
+Benchmark of the transcript compression in organizers_bot.compression.
+
+Compresses recorded message payloads (a messages.json / messages.orig.json from an
+export) or, without one, synthetic discord messages, with every available codec and
+reports the bytes that would be uploaded, the compression time and the time the upload
+itself would take at the given bandwidth. Checks that everything decompresses again.
+
+Usage: poetry run python benchmarks/compression.py [messages.json] [--mbps N] [--repeat N]
+"""
+import argparse
+import json
+import time
+
+from organizers_bot import compression
+from organizers_bot import jsoncodec
+
+from json_codec import synthetic
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("messages", nargs="?", help="recorded messages.json")
+    parser.add_argument("--count", type=int, default=20000, help="synthetic messages without a recording")
+    parser.add_argument("--mbps", type=float, default=50, help="upload bandwidth to s3 in Mbit/s")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.messages:
+        with open(args.messages, "rb") as f:
+            payload = json.load(f)
+    else:
+        payload = synthetic(args.count)
+    raw = jsoncodec.dumps(payload)
+    bytes_per_second = args.mbps * 1e6 / 8
+
+    print(f"{len(payload)} messages, upload at {args.mbps:.0f} Mbit/s")
+    print(f"{'none':>6}: {len(raw) / 1024:10.0f} KiB {0:8.1f} ms compress {len(raw) / bytes_per_second * 1000:8.0f} ms upload")
+    for name, codec in compression.codecs.items():
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            compressed = codec.compress(raw)
+            best = min(best, time.perf_counter() - start)
+        assert compression.decompress(compressed, name) == raw, f"{name} doesn't round trip"
+        upload = len(compressed) / bytes_per_second
+        print(f"{name:>6}: {len(compressed) / 1024:10.0f} KiB {best * 1000:8.1f} ms compress {upload * 1000:8.0f} ms upload"
+              f"  ({len(raw) / len(compressed):.1f}x smaller)")
+    if "zstd" not in compression.codecs:
+        print("(install zstandard to compare zstd as well)")
+
+if __name__ == "__main__":
+    main()
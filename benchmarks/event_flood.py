@@ -0,0 +1,110 @@
+"""
+Memory benchmark: RSS of the discord client state under a simulated event flood.
+
+Feeds synthetic gateway events (messages, typing, presences, members) into the
+client's connection state, dropping the ones discord would not send for the
+configured intents, and reports the RSS growth. Every setting runs in a fresh
+interpreter so the numbers don't influence each other.
+
+Usage: poetry run python benchmarks/event_flood.py [--events N] [--channels N]
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+
+# which intent discord requires before it sends an event
+EVENT_INTENTS = {
+    "MESSAGE_CREATE": "guild_messages",
+    "TYPING_START": "guild_typing",
+    "PRESENCE_UPDATE": "presences",
+    "GUILD_MEMBER_ADD": "members",
+}
+
+def rss_kb() -> int:
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def guild_payload(guild_id: int, channels: int) -> dict:
+    return {
+        "id": str(guild_id), "name": "bench", "owner_id": "1", "region": "europe",
+        "afk_channel_id": None, "afk_timeout": 300, "verification_level": 0,
+        "default_message_notifications": 0, "explicit_content_filter": 0, "roles": [],
+        "emojis": [], "features": [], "mfa_level": 0, "member_count": 0, "members": [],
+        "presences": [], "voice_states": [],
+        "channels": [{"id": str(guild_id + 1 + i), "type": 0, "name": f"chan-{i}",
+                      "position": i, "permission_overwrites": [], "guild_id": str(guild_id)}
+                     for i in range(channels)],
+    }
+
+def user_payload(i: int) -> dict:
+    return {"id": str(10_000_000 + i), "username": f"user{i}", "discriminator": f"{i % 10000:04}", "avatar": None}
+
+def event(kind: str, i: int, guild_id: int, channels: int) -> dict:
+    channel_id = str(guild_id + 1 + i % channels)
+    user = user_payload(i % 500)
+    if kind == "MESSAGE_CREATE":
+        return {"id": str(20_000_000 + i), "channel_id": channel_id, "guild_id": str(guild_id), "author": user,
+                "member": {"roles": [], "joined_at": "2021-01-01T00:00:00+00:00", "deaf": False, "mute": False},
+                "content": "x" * 200, "timestamp": "2021-01-01T00:00:00+00:00", "edited_timestamp": None,
+                "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [],
+                "attachments": [], "embeds": [], "pinned": False, "type": 0}
+    if kind == "TYPING_START":
+        return {"channel_id": channel_id, "guild_id": str(guild_id), "user_id": user["id"], "timestamp": 0,
+                "member": {"user": user, "roles": [], "joined_at": "2021-01-01T00:00:00+00:00", "deaf": False, "mute": False}}
+    if kind == "PRESENCE_UPDATE":
+        return {"user": user, "guild_id": str(guild_id), "status": "online", "activities": [], "client_status": {}}
+    return {"user": user, "guild_id": str(guild_id), "roles": [], "joined_at": "2021-01-01T00:00:00+00:00",
+            "deaf": False, "mute": False}
+
+def run_one(setting: str, events: int, channels: int):
+    import discord
+    from organizers_bot import config, bot
+
+    if setting == "default":
+        client = discord.Client(intents=discord.Intents.default())
+    else:
+        # only the gateway section matters here, the rest of a sample config is placeholders
+        # (e.g. the archive secret isn't hex) that config.load would reject
+        with open(setting) as f:
+            config.gateway = config.load_gateway(json.load(f))
+        client = discord.Client(**bot.client_options())
+    state = client._connection
+    guild_id = 1_000_000
+    state._add_guild_from_data(guild_payload(guild_id, channels))
+
+    kinds = list(EVENT_INTENTS)
+    before = rss_kb()
+    delivered = 0
+    for i in range(events):
+        kind = kinds[i % len(kinds)]
+        if not getattr(state._intents, EVENT_INTENTS[kind]):
+            continue
+        delivered += 1
+        getattr(state, "parse_" + kind.lower())(event(kind, i, guild_id, channels))
+    print(json.dumps({"setting": setting, "delivered": delivered, "rss_growth_kb": rss_kb() - before}))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=200_000)
+    parser.add_argument("--channels", type=int, default=300)
+    parser.add_argument("--config", default="config.sample.json",
+                        help="config.json whose gateway section is compared against discord.py's defaults")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_one(args.run_one, args.events, args.channels)
+        return
+
+    for setting in ["default", args.config]:
+        out = subprocess.run([sys.executable, __file__, "--run-one", setting,
+                              "--events", str(args.events), "--channels", str(args.channels)],
+                             capture_output=True, text=True, check=True).stdout
+        result = json.loads(out)
+        print(f"{result['setting']:>20}: {result['delivered']:>8} events delivered, "
+              f"RSS +{result['rss_growth_kb'] / 1024:.1f} MiB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Import-time report for the bot entry point, kept as a regression benchmark.
+
+Runs `python -X importtime -c "import organizers_bot.main"` in a fresh interpreter,
+prints the slowest imports and fails if one of the lazily loaded heavy
+dependencies (botocore, gql, ...) got imported eagerly again.
+
+Usage: poetry run python benchmarks/importtime.py [--top N]
+"""
+import argparse
+import subprocess
+import sys
+
+# these are only needed for /export and the ctfnote commands, see organizers_bot/lazy.py
+LAZY = ["aiobotocore", "botocore", "gql", "websockets"]
+
+def measure(target: str):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {target}"],
+                          capture_output=True, text=True, check=True)
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # keep the indentation of the name, it encodes the nesting level
+        entries.append((int(self_us), int(cumulative_us), name.rstrip()[1:]))
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--target", default="organizers_bot.main")
+    args = parser.parse_args()
+
+    entries = measure(args.target)
+    toplevel = [e for e in entries if not e[2].startswith(" ")]
+    total = sum(e[1] for e in toplevel)
+    print(f"{args.target}: {len(entries)} modules, {total / 1000:.1f} ms cumulative")
+    for self_us, cumulative_us, name in sorted(entries, key=lambda e: e[1], reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:9.1f} ms {self_us / 1000:9.1f} ms  {name}")
+
+    eager = sorted({e[2].strip() for e in entries if e[2].strip().split(".")[0] in LAZY})
+    if eager:
+        print("Imported eagerly but should be lazy:", ", ".join(eager))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Microbenchmark of the JSON backends in organizers_bot.jsoncodec.
+
+Encodes recorded message payloads (a messages.json / messages.orig.json from an
+export) or, without one, synthetic discord messages, with every available
+backend and checks that they all decode to the same value.
+
+Usage: poetry run python benchmarks/json_codec.py [messages.json] [--repeat N]
+"""
+import argparse
+import json
+import time
+
+from organizers_bot import jsoncodec
+
+def synthetic(count: int) -> list:
+    author = {"id": "123456789012345678", "username": "player", "avatar": "0123456789abcdef",
+              "discriminator": "1337", "public_flags": 0}
+    return [{
+        "id": str(900000000000000000 + i), "type": 0, "channel_id": "876543210987654321",
+        "author": author, "content": f"message {i}: trying a ret2libc, gadget at 0x4011de ✓ — ünïcode",
+        "attachments": [{"id": str(i), "filename": "exploit.py", "size": 1234,
+                         "url": f"https://cdn.discordapp.com/attachments/1/{i}/exploit.py",
+                         "proxy_url": f"https://media.discordapp.net/attachments/1/{i}/exploit.py"}] if i % 10 == 0 else [],
+        "embeds": [], "mentions": [], "mention_roles": [], "pinned": False, "mention_everyone": False,
+        "tts": False, "timestamp": "2022-06-25T12:34:56.789000+00:00", "edited_timestamp": None, "flags": 0,
+        "reactions": [{"emoji": {"id": None, "name": "🔥"}, "count": 2, "me": False}] if i % 7 == 0 else [],
+    } for i in range(count)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("messages", nargs="?", help="recorded messages.json")
+    parser.add_argument("--count", type=int, default=20000, help="synthetic messages without a recording")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.messages:
+        with open(args.messages, "rb") as f:
+            payload = json.load(f)
+    else:
+        payload = synthetic(args.count)
+
+    reference = json.loads(json.dumps(payload))
+    for name in jsoncodec.backends:
+        jsoncodec.use(name)
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            encoded = jsoncodec.dumps(payload)
+            best = min(best, time.perf_counter() - start)
+        assert json.loads(encoded) == reference, f"{name} output decodes to something else"
+        print(f"{name:>8}: {best * 1000:8.1f} ms for {len(payload)} messages, {len(encoded) / 1024:8.0f} KiB")
+
+if __name__ == "__main__":
+    main()
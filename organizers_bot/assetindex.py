@@ -0,0 +1,126 @@
+from . import config
+from . import jsoncodec
+import botocore.exceptions
+import logging
+import time
+import typing
+import urllib.parse
+
+log = logging.getLogger("assetindex")
+
+MANIFEST_KEY = "assets/index.json"
+# discord signs its cdn urls with an expiry, a new signature every time the message is fetched
+SIGNED_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+SIGNATURE_PARAMS = {"ex", "is", "hm"}
+
+def is_missing(e: botocore.exceptions.ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey")
+
+def url_key(url: str) -> str:
+    """
+        url without the signature discord puts on it, so the same file is found by the url of every fetch.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if not parts.query or parts.hostname not in SIGNED_HOSTS:
+        return url
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if k not in SIGNATURE_PARAMS]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+class AssetIndex:
+    """
+        What is stored in the bucket (key -> sha1, size, etag) and which url was stored under which key,
+        kept as a manifest object in the bucket itself. Loaded once per export, so assets we have already
+        don't cost a single s3 request, let alone a download.
+    """
+    def __init__(self):
+        self.entries: dict[str, dict] = {}
+        # source url -> key it is stored under
+        self.urls: dict[str, str] = {}
+        self.dirty = False
+
+    def get(self, key: str) -> typing.Optional[dict]:
+        return self.entries.get(key)
+
+    def add(self, key: str, sha1: str, size: int, etag: typing.Optional[str] = None, url: typing.Optional[str] = None):
+        self.entries[key] = {"sha1": sha1, "size": size, "etag": etag}
+        if url is not None:
+            self.urls[url_key(url)] = key
+        self.dirty = True
+
+    def remove(self, key: str):
+        if self.entries.pop(key, None) is not None:
+            self.prune()
+            self.dirty = True
+
+    def prune(self):
+        """
+            Forget the urls of keys we no longer have.
+        """
+        self.urls = {url: key for url, key in self.urls.items() if key in self.entries}
+
+    def key_for_url(self, url: str) -> typing.Optional[str]:
+        key = self.urls.get(url_key(url))
+        return key if key in self.entries else None
+
+    async def load(self, s3):
+        """
+            Read the manifest, or build it from the bucket if there is none (yet).
+        """
+        try:
+            resp = await s3.get_object(Bucket=config.s3.bucket_name, Key=MANIFEST_KEY)
+            data = jsoncodec.loads(await resp["Body"].read())
+            self.entries = data["entries"]
+            # manifests from before url_key still have every signed url
+            self.urls = {url_key(url): key for url, key in data["urls"].items()}
+            self.prune()
+            self.dirty = len(self.urls) != len(data["urls"])
+            log.info("Loaded asset index with %d entries", len(self.entries))
+        except botocore.exceptions.ClientError as e:
+            if not is_missing(e):
+                raise
+            log.info("No asset index in the bucket yet, building it")
+            await self.reconcile(s3)
+        except (ValueError, KeyError):
+            log.exception("Asset index is corrupt, rebuilding it")
+            await self.reconcile(s3)
+
+    async def reconcile(self, s3):
+        """
+            Bring the index in line with the bucket using a single paginated listing:
+            forget what is gone, add what we didn't know about.
+        """
+        start = time.monotonic()
+        seen = set()
+        paginator = s3.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=config.s3.bucket_name):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                if key == MANIFEST_KEY:
+                    continue
+                seen.add(key)
+                etag = obj.get("ETag")
+                entry = self.entries.get(key)
+                if entry is not None and entry["size"] == obj["Size"] and entry.get("etag") in (None, etag):
+                    entry["etag"] = etag
+                    continue
+                # content addressed keys carry their hash, for the others we find out when we next upload them
+                sha1 = key.split("/")[-1].split(".")[0] if key.startswith("assets/sha1/") else None
+                self.entries[key] = {"sha1": sha1, "size": obj["Size"], "etag": etag}
+        for key in set(self.entries) - seen:
+            del self.entries[key]
+        self.prune()
+        self.dirty = True
+        log.info("Reconciled asset index with the bucket in %.1fs: %d objects", time.monotonic() - start, len(self.entries))
+
+    async def save(self, s3):
+        if not self.dirty:
+            return
+        body = jsoncodec.dumps({"entries": self.entries, "urls": self.urls})
+        # whatever is added while this is uploaded makes it dirty again
+        self.dirty = False
+        try:
+            await s3.put_object(Bucket=config.s3.bucket_name, Key=MANIFEST_KEY, Body=body)
+        except BaseException:
+            self.dirty = True
+            raise
+        log.info("Saved asset index with %d entries", len(self.entries))
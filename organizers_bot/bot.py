@@ -1,8 +1,16 @@
 from . import config
-from . import transcript
-from . import ctfnote
+from . import commandsync
+from . import guildindex
+from . import jobs
+from . import serial
+from . import tracing
+from . import metrics
+from . import watchdog
+from . import profiler
+from . import lazy
 
 import asyncio
+import collections
 import functools
 import hashlib
 import io
@@ -10,6 +18,7 @@ import logging
 import typing
 import os
 import json
+import time
 
 import discord                                                                  # type: ignore
 import discord_slash                                                            # type: ignore
@@ -19,6 +28,25 @@ from discord.ext import tasks
 
 import traceback
 
+class StartupTimer:
+    """
+        Logs how long each startup phase took, relative to the previous phase and to process start.
+    """
+    def __init__(self):
+        self.log = logging.getLogger("startup")
+        self.start = self.last = time.monotonic()
+
+    def phase(self, name: str):
+        now = time.monotonic()
+        self.log.info("%s took %.3fs (%.3fs since start)", name, now - self.last, now - self.start)
+        self.last = now
+
+startup_timer = StartupTimer()
+
+# Exports and ctfnote calls are rare compared to starting the bot, don't pay for botocore and gql up front.
+transcript = lazy.LazyModule(".transcript", __package__)
+ctfnote = lazy.LazyModule(".ctfnote", __package__)
+
 def require_role(minreq=None):
     if minreq is None:
         minreq = config.mgmt.player_role
@@ -33,6 +61,99 @@ def require_role(minreq=None):
         return wrapper
     return decorator
 
+# command name -> Counter of "calls" and "deferred", how often auto_defer had to step in
+defer_stats: dict = collections.defaultdict(collections.Counter)
+
+def auto_defer(budget: typing.Optional[float] = None, hidden: bool = False):
+    """
+        Defer the interaction when the command did not respond within `budget` seconds
+        (config.bot.defer_budget by default), discord only waits 3 seconds for the first response.
+        After that, ctx.send fills in the deferred response and then sends followups.
+    """
+    defer_log = logging.getLogger("bot.defer")
+
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapper(ctx: discord_slash.SlashContext, *args, **kw):
+            loop = asyncio.get_event_loop()
+            # the automatic defer must not race with a response the handler is sending
+            lock = asyncio.Lock()
+            send, defer = ctx.send, ctx.defer
+            # the task in ctx.send, which defers by itself before sending files, with the lock held
+            sender: typing.Optional[asyncio.Task] = None
+            finished = False
+
+            async def locked_send(*a, **k):
+                nonlocal sender
+                async with lock:
+                    sender = asyncio.current_task()
+                    try:
+                        return await send(*a, **k)
+                    finally:
+                        sender = None
+
+            async def locked_defer(*a, **k):
+                if sender is not None and sender is asyncio.current_task():
+                    return await defer(*a, **k)
+                async with lock:
+                    if ctx.deferred or ctx.responded:
+                        return
+                    return await defer(*a, **k)
+
+            async def budget_exceeded():
+                async with lock:
+                    if finished or ctx.deferred or ctx.responded:
+                        return
+                    defer_stats[f.__name__]["deferred"] += 1
+                    defer_log.info("%s did not respond within %.1fs, deferring", f.__name__, limit)
+                    await defer(hidden=hidden)
+
+            budget_task: typing.Optional[asyncio.Task] = None
+
+            def start_budget_task():
+                nonlocal budget_task
+                budget_task = loop.create_task(budget_exceeded())
+
+            ctx.send, ctx.defer = locked_send, locked_defer
+            defer_stats[f.__name__]["calls"] += 1
+            limit = config.bot.defer_budget if budget is None else budget
+            timer = loop.call_later(limit, start_budget_task)
+            try:
+                return await f(ctx, *args, **kw)
+            finally:
+                # no defer once the handler is done, even if the timer fired just now
+                finished = True
+                timer.cancel()
+                if budget_task is not None and not lock.locked():
+                    budget_task.cancel()
+        return wrapper
+    return decorator
+
+def client_options() -> dict:
+    """
+        Only subscribe to the gateway events the bot uses and only cache what it needs.
+        All commands are slash interactions, which carry the invoking member themselves.
+    """
+    intents = discord.Intents.none()
+    # channels, categories and roles
+    intents.guilds = True
+    # keeps TextChannel.last_message_id up to date, the status board edits the last message in the transcript channel
+    intents.guild_messages = True
+    for name in config.gateway.intents:
+        setattr(intents, name, True)
+
+    if config.gateway.member_cache:
+        member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+    else:
+        member_cache_flags = discord.MemberCacheFlags.none()
+    return dict(
+            intents=intents,
+            # message history is always fetched over REST, we never look at cached messages
+            max_messages=config.gateway.max_messages or None,
+            member_cache_flags=member_cache_flags,
+            chunk_guilds_at_startup=config.gateway.member_cache and intents.members,
+            )
+
 def setup():
     assert config.is_loaded
 
@@ -40,13 +161,42 @@ def setup():
     # https://stackoverflow.com/a/51235308/2550406
     # It is mostly about convenience: commands.Bot subclasses discord.Client and offers some features.
     # I am not changing this now, since I see no urgent reason to do so.
-    bot = discord.Client(intents=discord.Intents.default())
-    slash = discord_slash.SlashCommand(bot, sync_commands=True)
+    bot = discord.Client(**client_options())
+    tracing.instrument_http(bot.http)
+    # We sync ourselves in on_ready, and only when the command set changed since the last sync.
+    slash = discord_slash.SlashCommand(bot, sync_commands=False)
     log = logging.getLogger("bot")
-    trans_mgr = transcript.TranscriptManager(bot)
+    trans_mgr = None
+    started = False
+    commands_synced = False
+    index = guildindex.GuildIndex()
+    # ctfnote side effects of commands, so players don't wait for ctfnote
+    ctfnote_jobs = jobs.JobQueue("ctfnote")
+    # commands touching a channel (and its status board entry) run one at a time per channel
+    executor = serial.KeyedExecutor("commands")
+    per_channel = serial.serialized(executor, lambda ctx, *args, **kw: ("channel", ctx.channel.id))
+    # only one ctf is tracked on the status board at a time
+    STATUS_BOARD = ("status board",)
+    metrics.Gauge("bot_job_queue_depth", "Queued and running background jobs", lambda: {("ctfnote",): ctfnote_jobs.depth}, ("queue",))
+    metrics.Gauge("bot_command_queue_depth", "Commands running or waiting, per busy channel (or the status board)",
+            lambda: {(key,): depth for key, (depth, _, _) in executor.busy().items()}, ("key",))
+    metrics.Gauge("bot_command_max_wait_seconds", "Longest wait for a busy channel (or the status board) since it got busy",
+            lambda: {(key,): wait for key, (_, _, wait) in executor.busy().items()}, ("key",))
+
+    async def warmup_ctfnote():
+        # import in the background, importing gql would otherwise block the loop on the first ctfnote command
+        await asyncio.get_event_loop().run_in_executor(None, ctfnote.load)
+        ctfnote.start_warmup(index.challenge_channels())
+        await ctfnote.wait_ready()
+        startup_timer.phase("ctfnote warmup")
+
+    @bot.event
+    async def on_connect():
+        startup_timer.phase("gateway connect")
 
     @bot.event
     async def on_ready():
+        nonlocal started, commands_synced
         guild = bot.get_guild(config.bot.guild)
 
         log.info(discord.utils.oauth_url(
@@ -54,31 +204,81 @@ def setup():
             guild=guild,
             scopes=["bot", "applications.commands"]
             ))
-        
+        # we may have missed channel events while disconnected
+        index.rebuild(guild)
+        # on_ready also fires after reconnects, only do the startup work once
+        # and retry only a command sync that failed.
+        if not started:
+            started = True
+            startup_timer.phase("gateway ready")
+            if config.ctfnote.enabled:
+                asyncio.get_event_loop().create_task(warmup_ctfnote())
+        if commands_synced:
+            return
+        try:
+            await commandsync.sync_if_changed(slash)
+            commands_synced = True
+        except Exception:
+            log.exception("Failed to sync slash commands")
+        startup_timer.phase("command sync")
+
+    @bot.event
+    async def on_guild_channel_create(channel: discord.abc.GuildChannel):
+        if channel.guild.id == config.bot.guild:
+            index.add(channel)
+
+    @bot.event
+    async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+        if channel.guild.id == config.bot.guild:
+            index.remove(channel)
+
+    @bot.event
+    async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        if after.guild.id != config.bot.guild:
+            return
+        old = index.challenges.get(after.id)
+        index.update(before, after)
+        new = index.challenges.get(after.id)
+        # keep the status of a renamed challenge
+        if old is not None and new is not None and (old.category, old.name) != (new.category, new.name):
+            chall = status_dict["challs"].get(old.category, {}).pop(old.name, None)
+            if chall is not None:
+                status_dict["challs"][new.category][new.name] = chall
+
     status_dict = {"type": "jeopardy", "challs": {cat: {} for cat in config.mgmt.categories}}
 
+    def chall_status(channel: discord.TextChannel) -> dict:
+        """
+            The status board entry of a challenge channel. Keyed on the challenge name, so it survives the solved prefix.
+        """
+        chall = index.challenge(channel.id)
+        return status_dict["challs"][chall.category][chall.name]
+
     @tasks.loop(seconds=15)
     async def display_status():
-        transcript_channel: discord.TextChannel = bot.get_channel(config.mgmt.transcript_channel)
-        status_msg = "```ansi\n"
-        for cat in config.mgmt.categories:
-            status_msg += "-"*30+"-+"+"-"*50 + f"\n\u001b[1;37m{cat.upper(): <30} \u001b[0;37m|\n"
-            for name, chall in status_dict["challs"][cat].items():
-                if chall["solved"]:
-                    status_msg += (f"{name: <{30}} | ✅\n")
-                elif chall["assigned"]:
-                    status_msg += (f"{name: <{30}} | {', '.join(chall['assigned']) or ''}\n")
-                else:
-                    status_msg += (f"{name: <{30}} | ❌\n")
-                if status_dict["type"] == "AD":
-                    for vuln_name, vuln in chall["vulns"].items():
-                        status_msg += " "*10 + f"{vuln_name: <20} | patch: {'✅' if vuln['patch'] else '❌'} | exploit: {'✅' if vuln['exploit'] else '❌'}\n"
-        status_msg += "-"*30+"-+"+"-"*50 + "\n```"
-        try:
-            message = await transcript_channel.fetch_message(transcript_channel.last_message_id)
-            await message.edit(content=status_msg)
-        except:
-            await transcript_channel.send(status_msg)
+        async with executor.hold(STATUS_BOARD):
+            transcript_channel: discord.TextChannel = bot.get_channel(config.mgmt.transcript_channel)
+            status_msg = "```ansi\n"
+            for cat in config.mgmt.categories:
+                status_msg += "-"*30+"-+"+"-"*50 + f"\n\u001b[1;37m{cat.upper(): <30} \u001b[0;37m|\n"
+                for name, chall in status_dict["challs"][cat].items():
+                    if chall["solved"]:
+                        status_msg += (f"{name: <{30}} | ✅\n")
+                    elif chall["assigned"]:
+                        status_msg += (f"{name: <{30}} | {', '.join(chall['assigned']) or ''}\n")
+                    else:
+                        status_msg += (f"{name: <{30}} | ❌\n")
+                    if status_dict["type"] == "AD":
+                        for vuln_name, vuln in chall["vulns"].items():
+                            status_msg += " "*10 + f"{vuln_name: <20} | patch: {'✅' if vuln['patch'] else '❌'} | exploit: {'✅' if vuln['exploit'] else '❌'}\n"
+            status_msg += "-"*30+"-+"+"-"*50 + "\n```"
+            try:
+                message = await transcript_channel.fetch_message(transcript_channel.last_message_id)
+                await message.edit(content=status_msg)
+                metrics.status_board_edits.inc("edit")
+            except:
+                await transcript_channel.send(status_msg)
+                metrics.status_board_edits.inc("send")
 
     @slash.slash(name="start",
                 description="Start ctf",
@@ -92,35 +292,36 @@ def setup():
                                     )])
     @require_role(config.mgmt.player_role)
     async def start_ctf(ctx: discord_slash.SlashContext, ctf_type: str):
-        status_dict["type"] = ctf_type
-        status_dict["challs"] = {cat: {} for cat in config.mgmt.categories}
-        try:
-            transcript_channel: discord.TextChannel = bot.get_channel(config.mgmt.transcript_channel)
-            message = await transcript_channel.fetch_message(transcript_channel.last_message_id)
-            curr_cat = None
-            curr_chal = None
-            chal = None
-            for line in message.content.split("\n"):
-                if line.startswith("-") or line.startswith("`"): continue
-                elif line.startswith("\u001b[1;37m"):
-                    curr_cat = line.split()[0].lstrip("\u001b[1;37m").rstrip("\u001b[0;37m").lower()
-                    curr_chal = None
-                elif line.startswith(" "):
-                    if status_dict["type"] == "AD":
-                        vuln_name, patch, exploit = line.split("|")
-                        chal["vulns"][vuln_name.strip()] = {"patch": "✅" in patch, "exploit": "✅" in exploit}
-                else:
-                    curr_chal, assigned = line.split("|")
-                    curr_chal = curr_chal.strip()
-                    chal = {"solved": False, "assigned": set(), "vulns": {}}
-                    if "✅" in assigned: chal["solved"] = True
-                    elif "❌" not in assigned:
-                        chal["assigned"] = set(map(lambda x: x.strip(), assigned.strip().split(",")))
+        async with executor.hold(STATUS_BOARD):
+            status_dict["type"] = ctf_type
+            status_dict["challs"] = {cat: {} for cat in config.mgmt.categories}
+            try:
+                transcript_channel: discord.TextChannel = bot.get_channel(config.mgmt.transcript_channel)
+                message = await transcript_channel.fetch_message(transcript_channel.last_message_id)
+                curr_cat = None
+                curr_chal = None
+                chal = None
+                for line in message.content.split("\n"):
+                    if line.startswith("-") or line.startswith("`"): continue
+                    elif line.startswith("\u001b[1;37m"):
+                        curr_cat = line.split()[0].lstrip("\u001b[1;37m").rstrip("\u001b[0;37m").lower()
+                        curr_chal = None
+                    elif line.startswith(" "):
+                        if status_dict["type"] == "AD":
+                            vuln_name, patch, exploit = line.split("|")
+                            chal["vulns"][vuln_name.strip()] = {"patch": "✅" in patch, "exploit": "✅" in exploit}
+                    else:
+                        curr_chal, assigned = line.split("|")
+                        curr_chal = curr_chal.strip()
+                        chal = {"solved": False, "assigned": set(), "vulns": {}}
+                        if "✅" in assigned: chal["solved"] = True
+                        elif "❌" not in assigned:
+                            chal["assigned"] = set(map(lambda x: x.strip(), assigned.strip().split(",")))
                     
-                if curr_cat is not None and curr_chal is not None:
-                    status_dict["challs"][curr_cat][curr_chal] = chal
-        except Exception as e:
-            log.error(f"Failed to load status from channel: {e}", exc_info=True)
+                    if curr_cat is not None and curr_chal is not None:
+                        status_dict["challs"][curr_cat][curr_chal] = chal
+            except Exception as e:
+                log.error(f"Failed to load status from channel: {e}", exc_info=True)
 
         display_status.start()
         await ctx.send(f"CTF started, type: {ctf_type}")
@@ -135,8 +336,10 @@ def setup():
                                     required=True
                                     )])
     @require_role(config.mgmt.player_role)
+    @auto_defer()
+    @per_channel
     async def add_vuln(ctx: discord_slash.SlashContext, vuln_name: str):
-        status_dict["challs"][ctx.channel.category.name][ctx.channel.name]["vulns"][vuln_name] = {"patch": False, "exploit": False}
+        chall_status(ctx.channel)["vulns"][vuln_name] = {"patch": False, "exploit": False}
         await ctx.send(f"Added vuln: {vuln_name}")
 
     @slash.slash(name="patch",
@@ -149,12 +352,15 @@ def setup():
                                     required=True
                                     )])
     @require_role(config.mgmt.player_role)
+    @auto_defer()
+    @per_channel
     async def mark_patched(ctx: discord_slash.SlashContext, vuln_name: str):
-        if vuln_name in status_dict["challs"][ctx.channel.category.name][ctx.channel.name]["vulns"]:
-            status_dict["challs"][ctx.channel.category.name][ctx.channel.name]["vulns"][vuln_name]["patch"] = True
+        vulns = chall_status(ctx.channel)["vulns"]
+        if vuln_name in vulns:
+            vulns[vuln_name]["patch"] = True
             await ctx.send(f"Marked vuln {vuln_name} as patched")
         else:
-            await ctx.send(f"Vuln {vuln_name} not found. Currently marked vulns: {', '.join(status_dict['challs'][ctx.channel.category.name][ctx.channel.name]['vulns'].keys())}")
+            await ctx.send(f"Vuln {vuln_name} not found. Currently marked vulns: {', '.join(vulns.keys())}")
     
     @slash.slash(name="exploit",
                 description="Mark a vuln as exploited",
@@ -166,12 +372,15 @@ def setup():
                                     required=True
                                     )])
     @require_role(config.mgmt.player_role)
+    @auto_defer()
+    @per_channel
     async def mark_exploited(ctx: discord_slash.SlashContext, vuln_name: str):
-        if vuln_name in status_dict["challs"][ctx.channel.category.name][ctx.channel.name]["vulns"]:
-            status_dict["challs"][ctx.channel.category.name][ctx.channel.name]["vulns"][vuln_name]["exploit"] = True
+        vulns = chall_status(ctx.channel)["vulns"]
+        if vuln_name in vulns:
+            vulns[vuln_name]["exploit"] = True
             await ctx.send(f"Marked vuln {vuln_name} as exploited")
         else:
-            await ctx.send(f"Vuln {vuln_name} not found. Currently marked vulns: {', '.join(status_dict['challs'][ctx.channel.category.name][ctx.channel.name]['vulns'].keys())}")
+            await ctx.send(f"Vuln {vuln_name} not found. Currently marked vulns: {', '.join(vulns.keys())}")
 
     @slash.slash(name="ping", description="Just a test, sleeps for 5 seconds then replies with 'pong'", guild_ids=[config.bot.guild])
     async def ping(ctx: discord_slash.SlashContext):
@@ -199,13 +408,18 @@ def setup():
                                       required=False)
                      ])
     @require_role(config.mgmt.player_role)
+    @auto_defer()
     async def create_challenge_channel(ctx: discord_slash.SlashContext, 
             category: str, challenge: str, ctfid = None):
-        cat = discord.utils.find(lambda c: c.name == category, ctx.guild.categories)
+        cat = index.category(category)
         created = await ctx.guild.create_text_channel(challenge, position=0, category=cat)
-        status_dict["challs"][category][created.name] = {"solved": False, "assigned": set(), "vulns": {}}
+        # don't wait for the gateway event, later commands in the new channel need it indexed
+        chall = index.add(created)
+        status_dict["challs"][category][chall.name if chall else created.name] = {"solved": False, "assigned": set(), "vulns": {}}
         await ctx.send(f"The channel for <#{created.id}> ({category}) was created")
-        await ctfnote.add_task(ctx, created, challenge, category, solved_prefix = "✓-", ctfid = ctfid)
+        ctfnote_jobs.submit(("add_task", created.id), "create the ctfnote task",
+                lambda: ctfnote.add_task(ctx, created, challenge, category, solved_prefix = "✓-", ctfid = ctfid),
+                channel=created, chain=created.id)
 
 
     @slash.slash(name="ctfnote_fixup_channel",
@@ -218,9 +432,20 @@ def setup():
                                       required=False)
                      ])
     @require_role(config.mgmt.player_role)
+    @auto_defer(hidden=True)
+    @per_channel
     async def ctfnote_fixup_channel(ctx: discord_slash.SlashContext, ctfid = None):
         await ctfnote.fixup_task(ctx, solved_prefix = "✓-", ctfid = ctfid)
 
+    # channel id -> its rename to the solved name, while in progress
+    renames: dict[int, asyncio.Task] = {}
+
+    async def rename_solved(channel: discord.TextChannel):
+        try:
+            await channel.edit(name=f"✓-{channel.name}", position=999)
+        except discord.HTTPException:
+            log.exception("Failed to mark %s as solved", channel.name)
+
     @slash.slash(name="solved",
                  description="The challenge was solved",
                  guild_ids=[config.bot.guild],
@@ -232,13 +457,16 @@ def setup():
                      ]
                  )
     @require_role(config.mgmt.player_role)
+    @auto_defer()
+    @per_channel
     async def mark_solved(ctx: discord_slash.SlashContext, flag: typing.Optional[str] = None):
         await ctx.defer()
-        if not ctx.channel.name.startswith("✓"):
-            status_dict["challs"][ctx.channel.category.name][ctx.channel.name]["solved"] = True
-            await ctx.channel.edit(name=f"✓-{ctx.channel.name}", position=999)
-
-        ctfnote_res = await ctfnote.update_flag(ctx, flag)
+        if not ctx.channel.name.startswith("✓") and ctx.channel.id not in renames:
+            chall_status(ctx.channel)["solved"] = True
+            # channel renames are rate limited hard, discord.py can sleep on one for minutes:
+            # don't hold up the other commands in the channel meanwhile
+            task = renames[ctx.channel.id] = asyncio.get_event_loop().create_task(rename_solved(ctx.channel))
+            task.add_done_callback(lambda _: renames.pop(ctx.channel.id, None))
 
         if flag is not None:
             msg = await ctx.send(f"The flag: `{flag}`")
@@ -246,6 +474,10 @@ def setup():
         else:
             await ctx.send("removed flag.")
 
+        ctfnote_jobs.submit(("update_flag", ctx.channel.id), "save the flag on ctfnote",
+                lambda: ctfnote.update_flag(ctx, flag), channel=ctx.channel, success_msg="Flag saved on ctfnote.",
+                chain=ctx.channel.id)
+
     @slash.slash(name="archive",
                  description="Move all current challenges to a new archive",
                  guild_ids=[config.bot.guild],
@@ -262,12 +494,10 @@ def setup():
             return
         await ctx.defer()
         new_cat = await ctx.guild.create_category(f"Archive-{name}", position=999)
-        for cat in ctx.guild.categories:
-            if cat.name not in config.mgmt.categories:
-                continue
-            for chan in cat.text_channels:
-                await chan.edit(category=new_cat)
-        status_dict["challs"] = {cat: {} for cat in config.mgmt.categories}
+        for chan in index.challenge_channels():
+            await chan.edit(category=new_cat)
+        async with executor.hold(STATUS_BOARD):
+            status_dict["challs"] = {cat: {} for cat in config.mgmt.categories}
         await display_status()
         display_status.cancel()
         await ctx.send(f"Archived {name}")
@@ -279,10 +509,15 @@ def setup():
                      create_option(name="category",
                                    description="Which category to move.",
                                    option_type=SlashCommandOptionType.CHANNEL,
-                                   required=True)
+                                   required=True),
+                     create_option(name="full",
+                                   description="Export everything again instead of only what's new since the last export.",
+                                   option_type=SlashCommandOptionType.BOOLEAN,
+                                   required=False),
                  ])
     @require_role(config.mgmt.player_role)
-    async def export(ctx: discord_slash.SlashContext, category: discord.abc.GuildChannel):
+    async def export(ctx: discord_slash.SlashContext, category: discord.abc.GuildChannel, full: bool = False):
+        nonlocal trans_mgr
         # hacky but idc
         # lucid: It seems this can be fixed by updating discordpy and discord_slash.
         if ctx.deferred or ctx.responded:
@@ -294,7 +529,9 @@ def setup():
             return
         log.info("Exporting %s", category.name, exc_info=True)
         await ctx.defer()
-        await trans_mgr.create(category, ctx)
+        if trans_mgr is None:
+            trans_mgr = transcript.TranscriptManager(bot)
+        await trans_mgr.create(category, ctx, full)
         # # TODO: Support specifying timezone?
         # if ctx.guild is None:
         #     return
@@ -373,6 +610,8 @@ def setup():
                                    required=True),
                  ])
     @require_role(config.mgmt.player_role)
+    @auto_defer()
+    @per_channel
     async def ctfnote_update_assigned_player(ctx: discord_slash.SlashContext, playername: discord.member.Member):
         await ctfnote.assign_player(ctx, playername)
 
@@ -386,8 +625,10 @@ def setup():
                         required=True),
                  ])
     @require_role(config.mgmt.player_role)
+    @auto_defer()
+    @per_channel
     async def update_assigned_player(ctx: discord_slash.SlashContext, playername: discord.member.Member):
-        status_dict["challs"][ctx.channel.category.name][ctx.channel.name]["assigned"].add(playername.name)
+        chall_status(ctx.channel)["assigned"].add(playername.name)
         await ctx.send(f"{playername.name} is now working on this challenge")
 
 
@@ -401,8 +642,10 @@ def setup():
                         required=True),
                  ])
     @require_role(config.mgmt.player_role)
+    @auto_defer()
+    @per_channel
     async def update_unassigned_player(ctx: discord_slash.SlashContext, playername: discord.member.Member):
-        status_dict["challs"][ctx.channel.category.name][ctx.channel.name]["assigned"].discard(playername.name)
+        chall_status(ctx.channel)["assigned"].discard(playername.name)
         await ctx.send(f"{playername.name} is no longer working on this challenge")
 
     @slash.slash(name="ctfnote_register_myself",
@@ -415,6 +658,7 @@ def setup():
                                    required=False),
                  ])
     @require_role(config.mgmt.player_role)
+    @auto_defer(hidden=True)
     async def ctfnote_register_myself(ctx: discord_slash.SlashContext, password: str = None):
         await ctfnote.register_themselves(ctx, password or None)
 
@@ -443,20 +687,66 @@ def setup():
                  guild_ids=[config.bot.guild])
     async def stats(ctx: discord_slash.SlashContext):
         log.info("Running Stats command")
-        num_channels = len(ctx.guild.channels)
-        num_cats = 0
-        for chan in ctx.guild.channels:
-            log.debug("Channel: %s", chan.name)
-            chan: discord.abc.GuildChannel
-            if isinstance(chan, discord.CategoryChannel):
-                num_cats += 1
-        
-        await ctx.send(f"Channels: {num_channels}/500, {500 - num_channels} left\nCategories: {num_cats}")
+        num_channels = index.channel_count
+        max_channels = guildindex.MAX_CHANNELS
+        await ctx.send(f"Channels: {num_channels}/{max_channels}, {max_channels - num_channels} left\nCategories: {index.category_count}")
+
+    @slash.slash(name="perf",
+                 description="Latency percentiles of the slash commands",
+                 guild_ids=[config.bot.guild])
+    @require_role(config.mgmt.admin_role)
+    async def perf(ctx: discord_slash.SlashContext):
+        lines = [f"{'command': <24} {'calls': >6} {'p50': >7} {'p95': >7} {'p99': >7} {'deferred': >8}"]
+        for name, (calls, p50, p95, p99) in sorted(tracing.summary().items()):
+            # defer_stats is keyed on the handler's name, not the command's
+            deferred = defer_stats[slash.commands[name].func.__name__]["deferred"]
+            lines.append(f"{name: <24} {calls: >6} {p50 * 1000: >5.0f}ms {p95 * 1000: >5.0f}ms {p99 * 1000: >5.0f}ms {deferred: >8}")
+        samples, p50, p95, p99 = watchdog.summary()
+        lines.append(f"{'(event loop lag)': <24} {samples: >6} {p50 * 1000: >5.0f}ms {p95 * 1000: >5.0f}ms {p99 * 1000: >5.0f}ms")
+        lines.append(f"event loop blocked > {config.watchdog.threshold}s: {watchdog.stalls} times")
+        busy = executor.busy()
+        if busy:
+            lines.append(f"{'busy': <24} {'queued': >6} {'runs': >7} {'max wait': >9}")
+        for key, (depth, runs, max_wait) in sorted(busy.items()):
+            lines.append(f"{key: <24} {depth: >6} {runs: >7} {max_wait * 1000: >7.0f}ms")
+        await ctx.send("```\n" + "\n".join(lines) + "\n```", hidden=True)
+
+    @slash.slash(name="profile",
+                 description="Profile the bot for a while, the report goes to the transcript channel",
+                 guild_ids=[config.bot.guild],
+                 options=[
+                     create_option(name="seconds",
+                                   description="How long to profile (default 30, at most 600)",
+                                   option_type=SlashCommandOptionType.INTEGER,
+                                   required=False),
+                     create_option(name="memory",
+                                   description="Also report which allocations grew (tracemalloc, slows the bot down)",
+                                   option_type=SlashCommandOptionType.BOOLEAN,
+                                   required=False),
+                 ])
+    @require_role(config.mgmt.admin_role)
+    async def profile(ctx: discord_slash.SlashContext, seconds: int = 30, memory: bool = False):
+        seconds = max(1, min(seconds, 600))
+        await ctx.defer(hidden=True)
+        files = await profiler.capture(seconds, trace_memory=memory)
+        transcript_channel: discord.TextChannel = bot.get_channel(config.mgmt.transcript_channel)
+        msg = await transcript_channel.send(f"Profile of {seconds}s requested by {ctx.author.name}",
+                files=[discord.File(io.BytesIO(contents.encode()), filename=name) for name, contents in files.items()])
+        await ctx.send(f"Profile uploaded [here]({msg.jump_url})", hidden=True)
+
+    # every command gets a root span for its latency, the discord/ctfnote/s3 calls are its children
+    for cmd in slash.commands.values():
+        cmd.func = tracing.traced(cmd.name)(cmd.func)
 
     ## Keep this last :)
     return bot
 
 def run(loop: asyncio.AbstractEventLoop):
     bot = setup()
+    startup_timer.phase("command setup")
+    if config.metrics.enabled:
+        metrics.start(loop)
+    if config.watchdog.enabled:
+        watchdog.start(loop)
     bot.loop = loop
     loop.create_task(bot.start(config.bot.token))
@@ -0,0 +1,56 @@
+from . import config
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import time
+
+import discord_slash                                                            # type: ignore
+
+log = logging.getLogger("commandsync")
+
+def fingerprint(cmds: dict) -> str:
+    """
+        Stable hash over the full command set as discord_slash would send it to discord:
+        names, descriptions, options and choices for every scope.
+    """
+    encoded = json.dumps(cmds, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf8")).hexdigest()
+
+def load_cached(path: pathlib.Path):
+    """
+        Returns the fingerprint of the last successful sync, or None if there is none (or it is unreadable).
+    """
+    try:
+        with path.open("r") as f:
+            return json.load(f).get("fingerprint")
+    except (OSError, ValueError):
+        return None
+
+def store_cached(path: pathlib.Path, fp: str):
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as f:
+        json.dump({"fingerprint": fp, "synced_at": int(time.time())}, f)
+    os.replace(tmp, path)
+
+async def sync_if_changed(slash: discord_slash.SlashCommand) -> bool:
+    """
+        Only talk to discord about our commands if they changed since the last successful sync.
+        Remove the cache file (config.bot.command_cache) to force a sync.
+        Returns whether a sync was performed.
+    """
+    path = pathlib.Path(config.bot.command_cache)
+    cmds = await slash.to_dict()
+    fp = fingerprint(cmds)
+    if fp == load_cached(path):
+        log.info("Slash commands unchanged (%s), skipping sync", fp[:12])
+        return False
+
+    log.info("Slash commands changed (%s), syncing with discord", fp[:12])
+    await slash.sync_all_commands()
+    try:
+        store_cached(path, fp)
+    except OSError:
+        log.warning("Could not store command fingerprint at %s", path, exc_info=True)
+    return True
@@ -0,0 +1,125 @@
+import functools
+import gzip
+import io
+import logging
+import struct
+import typing
+import zlib
+
+log = logging.getLogger("compression")
+
+# Compression of the exported JSON. Objects are stored under their usual names with a
+# Content-Encoding, so the archive site can hand them to browsers as they are.
+# A streamed gzip object is always a single member, browsers don't all read past the first one;
+# exports that append to it continue the member where the previous one cut it off.
+# zstd decoders must read every frame (RFC 8878), a streamed zstd object gets a new frame per append.
+try:
+    import zstandard                                                            # type: ignore
+except ImportError:
+    zstandard = None
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# magic, deflate, no flags, no mtime, no extra flags, unknown OS
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+class GzipStream:
+    """
+        Streaming compressor of a single gzip member. cut() ends what was written so far at a byte
+        boundary with a fresh deflate window: the member can be cut off there and continued later by
+        a GzipStream made from the state() it had then.
+    """
+    def __init__(self, state: typing.Optional[list] = None):
+        self.deflate = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # the crc32 and size of everything in the member so far
+        self.crc: int = state[0] if state else 0
+        self.size: int = state[1] if state else 0
+        self.header = GZIP_HEADER if state is None else b""
+
+    def _out(self, data: bytes) -> bytes:
+        out, self.header = self.header + data, b""
+        return out
+
+    def compress(self, data: bytes) -> bytes:
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return self._out(self.deflate.compress(data))
+
+    def cut(self) -> bytes:
+        return self._out(self.deflate.flush(zlib.Z_FULL_FLUSH))
+
+    def flush(self) -> bytes:
+        return self._out(self.deflate.flush(zlib.Z_FINISH) + struct.pack("<II", self.crc, self.size & 0xffffffff))
+
+    def state(self) -> list:
+        return [self.crc, self.size]
+
+class ZstdStream:
+    """
+        Streaming zstd compressor, like GzipStream. A frame can't be continued, so cut() ends it and
+        starts the next one.
+    """
+    def __init__(self, state: None = None):
+        self.obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.obj.compress(data)
+
+    def cut(self) -> bytes:
+        out = self.obj.flush()
+        self.obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return out
+
+    def flush(self) -> bytes:
+        return self.obj.flush()
+
+    def state(self) -> None:
+        return None
+
+def _zstd_compress(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+class Codec:
+    """
+        `compress` compresses a whole object, it is a module level function so it pickles for the offload
+        process pool. `compressor(state=None)` makes a streaming compressor (GzipStream/ZstdStream),
+        continuing where one with that state() was cut off.
+    """
+    def __init__(self, name: str, compress: typing.Callable[[bytes], bytes], compressor: typing.Callable):
+        self.name = name
+        self.compress = compress
+        self.compressor = compressor
+
+codecs: dict = {
+    "gzip": Codec("gzip", functools.partial(gzip.compress, compresslevel=GZIP_LEVEL, mtime=0), GzipStream),
+}
+if zstandard is not None:
+    codecs["zstd"] = Codec("zstd", _zstd_compress, ZstdStream)
+
+def get(name: str) -> typing.Optional[Codec]:
+    """
+        The codec called name, None for "none". Falls back to gzip when zstandard isn't installed.
+    """
+    if name == "none":
+        return None
+    if name not in codecs:
+        log.warning("Compression %s is not available, using gzip", name)
+        name = "gzip"
+    return codecs[name]
+
+def decompress(data: bytes, encoding: typing.Optional[str]) -> bytes:
+    """
+        Contents of an object stored with Content-Encoding `encoding`, all members/frames of it.
+    """
+    if not encoding:
+        return data
+    if encoding == "gzip":
+        # unlike zlib, gzip.decompress reads every member
+        return gzip.decompress(data)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed to read zstd objects")
+        with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True) as reader:
+            return reader.read()
+    raise ValueError(f"Unknown encoding {encoding}")
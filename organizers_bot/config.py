@@ -8,6 +8,9 @@ class BotConfig:
     token: str
     client_id: int
     guild: int
+    command_cache: str = "command_cache.json"
+    # seconds a command may take before we defer its interaction, discord gives up after 3
+    defer_budget: float = 2.0
 
 @dataclasses.dataclass
 class ManagementConfig:
@@ -23,6 +26,10 @@ class S3Config:
     bucket_name: str
     key: str
     keyID: str
+    # assets larger than this are streamed to s3 in parts of this size (s3 wants at least 5 MiB)
+    part_size: int = 8 * 1024 * 1024
+    # bytes of assets buffered across all concurrent transfers of the export
+    memory_budget: int = 64 * 1024 * 1024
 
 @dataclasses.dataclass
 class ArchiveConfig:
@@ -36,14 +43,79 @@ class CtfNoteConfig:
     admin_pass: str
     enabled: bool
 
+@dataclasses.dataclass
+class GatewayConfig:
+    # extra intents on top of the ones the bot's features need, e.g. ["members"]
+    intents: list[str] = dataclasses.field(default_factory=list)
+    # size of the message cache, 0 disables it
+    max_messages: int = 0
+    # cache (and at startup, chunk) guild members. Requires the members intent.
+    member_cache: bool = False
+
+@dataclasses.dataclass
+class MetricsConfig:
+    # serve OpenMetrics on http://host:port/metrics
+    enabled: bool = False
+    host: str = "127.0.0.1"
+    port: int = 9100
+
+@dataclasses.dataclass
+class WatchdogConfig:
+    enabled: bool = True
+    # seconds the event loop may be blocked before we log what blocks it
+    threshold: float = 0.25
+    # seconds between lag measurements
+    interval: float = 0.5
+    # also let asyncio log slow callbacks itself, at the cost of debug mode overhead
+    asyncio_debug: bool = False
+
+@dataclasses.dataclass
+class OffloadConfig:
+    # "thread" or "process". Threads suffice for hashing (hashlib releases the GIL),
+    # json encoding only runs in parallel with the loop in a process.
+    kind: str = "thread"
+    workers: int = 2
+    # smaller inputs are handled on the event loop, the round trip would cost more than it saves
+    min_bytes: int = 1024 * 1024
+    min_items: int = 500
+
+@dataclasses.dataclass
+class ExportConfig:
+    # channels whose history is fetched at the same time
+    channels: int = 4
+    # downloads/uploads running at the same time, across all channels
+    transfers: int = 8
+    # items each queue between the stages holds before the stage feeding it waits
+    queue_size: int = 100
+    # messages are written as "json" (an array, messages.json) or "ndjson" (messages.ndjson)
+    format: str = "json"
+    # of the transcript JSON: "gzip", "zstd" (needs zstandard installed) or "none"
+    compression: str = "gzip"
+    # store the originals plus a rewrite map (rewrites.json) instead of the archived view (messages.json) as well,
+    # for an archive site that applies the map itself
+    single_copy: bool = False
+
+def load_gateway(conf: dict) -> GatewayConfig:
+    """
+        The gateway section of a parsed config.json, also used on its own by benchmarks/event_flood.py.
+    """
+    gateway_conf = conf.get('gateway', {})
+    return GatewayConfig(
+        gateway_conf.get('intents', []),
+        gateway_conf.get('max_messages', 0),
+        gateway_conf.get('member_cache', False),
+    )
+
 def load(filename: pathlib.Path):
-    global is_loaded, bot, mgmt, s3, archive, ctfnote
+    global is_loaded, bot, mgmt, s3, archive, ctfnote, gateway, metrics, watchdog, offload, export
     with filename.open("r") as configfile:
         conf = json.load(configfile)
         bot = BotConfig(
                 conf['bot']['token'],
                 conf['bot']['client_id'],
                 conf['bot']['guild'],
+                conf['bot'].get('command_cache', "command_cache.json"),
+                conf['bot'].get('defer_budget', 2.0),
                 )
         mgmt = ManagementConfig(
                 conf['mgmt']['categories'],
@@ -56,7 +128,9 @@ def load(filename: pathlib.Path):
             conf['s3']['bucket'],
             conf['s3']['bucket_name'],
             conf['s3']['key'],
-            conf['s3']['keyID']
+            conf['s3']['keyID'],
+            conf['s3'].get('part_size', 8 * 1024 * 1024),
+            conf['s3'].get('memory_budget', 64 * 1024 * 1024),
         )
         archive = ArchiveConfig(
             conf['archive']['url'],
@@ -68,6 +142,36 @@ def load(filename: pathlib.Path):
             conf['ctfnote']['admin_pass'],
             conf['ctfnote']['enabled']
         )
+        gateway = load_gateway(conf)
+        metrics_conf = conf.get('metrics', {})
+        metrics = MetricsConfig(
+            metrics_conf.get('enabled', False),
+            metrics_conf.get('host', "127.0.0.1"),
+            metrics_conf.get('port', 9100),
+        )
+        watchdog_conf = conf.get('watchdog', {})
+        watchdog = WatchdogConfig(
+            watchdog_conf.get('enabled', True),
+            watchdog_conf.get('threshold', 0.25),
+            watchdog_conf.get('interval', 0.5),
+            watchdog_conf.get('asyncio_debug', False),
+        )
+        offload_conf = conf.get('offload', {})
+        offload = OffloadConfig(
+            offload_conf.get('kind', "thread"),
+            offload_conf.get('workers', 2),
+            offload_conf.get('min_bytes', 1024 * 1024),
+            offload_conf.get('min_items', 500),
+        )
+        export_conf = conf.get('export', {})
+        export = ExportConfig(
+            export_conf.get('channels', 4),
+            export_conf.get('transfers', 8),
+            export_conf.get('queue_size', 100),
+            export_conf.get('format', "json"),
+            export_conf.get('compression', "gzip"),
+            export_conf.get('single_copy', False),
+        )
     is_loaded = True
 
 logging.basicConfig(level=logging.INFO)
@@ -77,3 +181,8 @@ mgmt: ManagementConfig
 s3: S3Config
 archive: ArchiveConfig
 ctfnote: CtfNoteConfig
+gateway: GatewayConfig
+metrics: MetricsConfig
+watchdog: WatchdogConfig
+offload: OffloadConfig
+export: ExportConfig
@@ -15,16 +15,86 @@ from datetime import datetime
 import dateutil # parser, tz
 import logging
 import asyncio
+import collections
+import functools
+import time
+import typing
 from . import queries
 import discord
 import discord_slash                                                            # type: ignore
 import json
-import pathlib
+from graphql import OperationDefinitionNode
 from . import config
-config.load(pathlib.Path("config.json"))
+from . import tracing
+from . import metrics
+from . import jsoncodec
+# config is loaded once by main, this module is only imported (lazily) afterwards.
+assert config.is_loaded
 
 log = logging.getLogger("CTFNote")
 
+class TracedClient(Client):
+    """
+        gql client that adds a tracing span named after the operation for every request.
+    """
+    async def execute_async(self, document, *args, **kwargs):
+        op = next((d.name.value for d in document.definitions
+                if isinstance(d, OperationDefinitionNode) and d.name is not None), "anonymous")
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            with tracing.span(f"ctfnote {op}"):
+                result = await super().execute_async(document, *args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            metrics.graphql_requests.inc(op, outcome)
+            metrics.graphql_duration.observe(time.monotonic() - start, op)
+
+class SingleFlight:
+    """
+        Lets concurrent callers of the same read share one request instead of each sending their own,
+        e.g. when several players run commands in the same channel right after a solve.
+    """
+    def __init__(self):
+        self.inflight: dict = {}
+        # operation name -> Counter of "executed" and "collapsed" requests
+        self.stats: dict = collections.defaultdict(collections.Counter)
+
+    async def do(self, key, op: str, fetch, fresh: bool = False):
+        """
+            Returns the result of `await fetch()`, or of the identical request that is already in flight.
+            With `fresh`, always start a new request (e.g. to see the result of a mutation), later callers join that one.
+        """
+        fut = self.inflight.get(key)
+        if fut is not None and not fresh:
+            self.stats[op]["collapsed"] += 1
+            metrics.graphql_collapsed.inc(op)
+        else:
+            self.stats[op]["executed"] += 1
+            fut = asyncio.ensure_future(fetch())
+            self.inflight[key] = fut
+            fut.add_done_callback(lambda f: self.inflight.pop(key, None) if self.inflight.get(key) is f else None)
+        # one caller giving up must not cancel the request for the others
+        return await asyncio.shield(fut)
+
+flights = SingleFlight()
+
+@functools.lru_cache(maxsize=None)
+def document(name: str):
+    """
+        The parsed query `name` from the queries module.
+    """
+    return gql.gql(getattr(queries, name))
+
+async def read(client: Client, name: str, variables: typing.Optional[dict] = None, fresh: bool = False):
+    """
+        Run the read-only query `name` from the queries module, sharing identical concurrent requests.
+    """
+    key = (id(client), name, json.dumps(variables, sort_keys=True))
+    return await flights.do(key, name,
+            lambda: client.execute_async(document(name), variable_values=variables), fresh)
+
 class Task:
     def __init__(self, parent, client, meta):
         self.client = client
@@ -54,7 +124,7 @@ class Task:
             "description": self.desc,
             "flag": self.flag,
         })
-        await self.parent._fullupdate()
+        await self.parent._fullupdate(fresh=True)
 
     async def updateTitle(self, newtitle: str):
         """
@@ -80,7 +150,7 @@ class Task:
         result = await self.client.execute_async(query, variable_values={
             "id": self.id
         })
-        await self.parent._fullupdate()
+        await self.parent._fullupdate(fresh=True)
 
     async def startWorkingOn(self):
         """
@@ -143,11 +213,8 @@ class CTF:
         else:
             self.tasks = []
 
-    async def _fullupdate(self):
-        query = gql.gql(queries.get_full_ctf)
-        result = await self.client.execute_async(query, variable_values={
-            "id": self.id
-        })
+    async def _fullupdate(self, fresh: bool = False):
+        result = await read(self.client, "get_full_ctf", {"id": self.id}, fresh)
         self._update(result["ctf"])
 
     async def getTask(self, id: int):
@@ -173,7 +240,7 @@ class CTF:
             Get task id from pinned message in current channel,
             find it in the ctfnote response, return it.
         """
-        botdb = (await extract_botdb(await get_pinned_ctfnote_message(ctx)))
+        botdb = await get_channel_botdb(ctx.channel)
         stored_challenge_id = (botdb or dict()).get('chalid', None)
         await self._fullupdate()
         return next(filter(lambda x: x.id == stored_challenge_id, self.tasks), None)
@@ -205,7 +272,7 @@ class CTF:
 
 
         if not result["createTask"]:
-            await self._fullupdate()
+            await self._fullupdate(fresh=True)
 
             present_task = list(filter(lambda t: t.title == name and 
                     t.category == category, self.tasks))
@@ -227,7 +294,7 @@ class CTFNote:
         new account with username and password and the required token
         """
         transport = AIOHTTPTransport(url=self.url)
-        client = Client(transport=transport, fetch_schema_from_transport=False)
+        client = TracedClient(transport=transport, fetch_schema_from_transport=False)
         self.users = []
 
         if token:
@@ -243,7 +310,7 @@ class CTFNote:
                     url=self.url,
                     headers={"Authorization": f"Bearer {self.token}"}
                 )
-            self.client = Client(
+            self.client = TracedClient(
                     transport=self.transport, 
                     fetch_schema_from_transport=False
                 )
@@ -260,7 +327,7 @@ class CTFNote:
                     url=self.url,
                     headers={"Authorization": f"Bearer {self.token}"}
                 )
-            self.client = Client(
+            self.client = TracedClient(
                     transport=self.transport, 
                     fetch_schema_from_transport=False
                 )
@@ -269,8 +336,7 @@ class CTFNote:
         """
         Retrieve the current logged in account
         """
-        query = gql.gql(queries.get_me)
-        result = await self.client.execute_async(query)
+        result = await read(self.client, "get_me")
         return result["me"]
 
 
@@ -278,8 +344,7 @@ class CTFNote:
         """
         Retrieve the team you're in right now
         """
-        query = gql.gql(queries.get_team)
-        result = await self.client.execute_async(query)
+        result = await read(self.client, "get_team")
         return result["profiles"]["nodes"]
 
     async def getPastCtfs(self,first=20,offset=0):
@@ -289,8 +354,7 @@ class CTFNote:
         :ivar int first: Limit the results to the first few results
         :ivar int offset: Start search after the first offset many results
         """
-        query = gql.gql(queries.get_past_ctfs)
-        result = await self.client.execute_async(query,variable_values={
+        result = await read(self.client, "get_past_ctfs", {
             "first":first,
             "offset":offset
         })
@@ -300,16 +364,14 @@ class CTFNote:
         """
         Retrieve a list of upcoming CTFs. Seems to also contain currently ongoing CTFs.
         """
-        query = gql.gql(queries.get_incoming_ctfs)
-        result = await self.client.execute_async(query)
+        result = await read(self.client, "get_incoming_ctfs")
         return result["incomingCtf"]["nodes"]
 
     async def getCtfs(self):
         """
         Retrieve a list of all CTFs
         """
-        query = gql.gql(queries.get_ctfs)
-        result = await self.client.execute_async(query)
+        result = await read(self.client, "get_ctfs")
         return result["ctfs"]["nodes"]
 
     async def _importCtf(self, id: int):
@@ -394,11 +456,7 @@ class CTFNote:
         """
         Get the full representation of the CTF with a given id
         """
-        query = gql.gql(queries.get_full_ctf)
-            
-        result = await self.client.execute_async(query, variable_values={
-            "id": id
-        })
+        result = await read(self.client, "get_full_ctf", {"id": id})
         ctf = CTF(self.client, result["ctf"])
         return ctf
     
@@ -427,8 +485,7 @@ class CTFNote:
         return result["newToken"]
 
     async def getUsers(self):
-        query = gql.gql(queries.get_users)
-        result = await self.client.execute_async(query)
+        result = await read(self.client, "get_users")
         return result["users"]["nodes"]
 
     def getUserIdOf(self, username: str):
@@ -440,15 +497,9 @@ class CTFNote:
         return 0
 
     async def getActiveCtfs(self):
-        ctfs = await self.getIncomingCtfs()
-        now = datetime.now(dateutil.tz.UTC)
-        ctfs = list(filter(lambda ctf: 
-            dateutil.parser.isoparse(ctf["startTime"]) < now and
-            dateutil.parser.isoparse(ctf["endTime"]) > now, ctfs))
-
         # This is a list. Use an element like this:
         # return CTF(self.client, ctfs[0]) if ctfs else None
-        return ctfs
+        return filter_active(await self.getIncomingCtfs())
 
     async def subscribe_to_events(self):
         loop = asyncio.get_event_loop()
@@ -470,16 +521,147 @@ class CTFNote:
         loop.create_task(start_listening(queries.subscribe_to_ctf, "ctf_event"))
         loop.create_task(start_listening(queries.subscribe_to_task, "task_event"))
 
+def filter_active(ctfs: list):
+    """
+        Only keep the CTFs that are running right now.
+    """
+    now = datetime.now(dateutil.tz.UTC)
+    return list(filter(lambda ctf: 
+        dateutil.parser.isoparse(ctf["startTime"]) < now and
+        dateutil.parser.isoparse(ctf["endTime"]) > now, ctfs))
+
 URL = config.ctfnote.URL
 admin_login = config.ctfnote.admin_login
 admin_pass = config.ctfnote.admin_pass
 enabled: bool = config.ctfnote.enabled
 ctfnote: CTFNote = CTFNote(URL)
 
+# State that warmup() loads on startup, so the first command after a restart
+# is not slower than any other. Commands can check `ready` or `await wait_ready()`.
+ready: bool = False
+_warmup_task: typing.Optional[asyncio.Task] = None
+# How long the ctf and user lists are reused before asking ctfnote again.
+CACHE_TTL = 5 * 60
+_cache: dict = {}
+# ctf id -> CTF object including its tasks
+ctf_objects: dict = {}
+# channel id -> botdb dict of the pinned ctfnote message, None if the channel has none
+channel_botdbs: dict = {}
+
 async def login():
     global ctfnote
     ctfnote = CTFNote(URL + "graphql")
     await ctfnote.login(admin_login, admin_pass)
+    # the cached objects hold on to the old client
+    ctf_objects.clear()
+    _cache.clear()
+
+async def cached(key: str, fetch, refresh: bool = False):
+    """
+        Returns the result of `await fetch()`, reusing it for CACHE_TTL seconds.
+    """
+    hit = _cache.get(key)
+    if not refresh and hit is not None and time.monotonic() - hit[0] < CACHE_TTL:
+        metrics.cache_requests.inc(key, "hit")
+        return hit[1]
+    metrics.cache_requests.inc(key, "miss")
+    result = await fetch()
+    _cache[key] = (time.monotonic(), result)
+    return result
+
+def invalidate(key: str):
+    _cache.pop(key, None)
+
+async def get_ctfs(refresh: bool = False):
+    return await cached("ctfs", ctfnote.getCtfs, refresh)
+
+async def get_active_ctfs(refresh: bool = False):
+    return filter_active(await cached("incoming", ctfnote.getIncomingCtfs, refresh))
+
+async def get_users(refresh: bool = False):
+    return await cached("users", ctfnote.getUsers, refresh)
+
+async def find_user(login_name: str):
+    """
+        Returns the ctfnote user with the given login, asking ctfnote again before giving up
+        since the cached list does not know about accounts created in the meantime.
+    """
+    for refresh in (False, True):
+        user = next(filter(lambda x: x['login'] == login_name, await get_users(refresh)), None)
+        if user is not None:
+            return user
+    return None
+
+def ctf_object(meta: dict):
+    """
+        Reuse the CTF object (and the tasks it already knows about) for this ctf if we have one.
+    """
+    ctf = ctf_objects.get(meta["id"])
+    if ctf is None:
+        ctf = ctf_objects[meta["id"]] = CTF(ctfnote.client, meta)
+    return ctf
+
+async def get_channel_botdb(channel: discord.TextChannel):
+    """
+        The botdb of the pinned ctfnote message in the channel, without fetching the pins every time.
+        Channels without one aren't cached, so a pin created later is found.
+    """
+    if channel.id in channel_botdbs:
+        metrics.cache_requests.inc("botdb", "hit")
+        return channel_botdbs[channel.id]
+    metrics.cache_requests.inc("botdb", "miss")
+    botdb = await extract_botdb(await get_pinned_message(channel))
+    if botdb is not None:
+        channel_botdbs[channel.id] = botdb
+    return botdb
+
+# pin fetches the warmup runs at the same time
+WARMUP_PIN_FETCHES = 4
+
+async def warmup(channels: list):
+    """
+        Concurrently log in and load everything the commands need: the ctf list, the active ctfs
+        with their tasks, the users, and the ctfnote binding of the given challenge channels.
+    """
+    global ready
+    if not enabled:
+        return
+    start = time.monotonic()
+
+    async def load_ctfnote():
+        await login()
+        _, active, _ = await asyncio.gather(get_ctfs(), get_active_ctfs(), get_users())
+        full = await asyncio.gather(*(ctfnote.getFullCtf(ctf["id"]) for ctf in active))
+        for ctf in full:
+            ctf_objects[ctf.id] = ctf
+
+    pin_fetches = asyncio.Semaphore(WARMUP_PIN_FETCHES)
+
+    async def load_botdb(chan: discord.TextChannel):
+        async with pin_fetches:
+            await get_channel_botdb(chan)
+
+    results = await asyncio.gather(load_ctfnote(),
+            *(load_botdb(chan) for chan in channels), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            log.error("CTFNote warmup step failed", exc_info=result)
+    if isinstance(results[0], BaseException):
+        return
+    ready = True
+    log.info("CTFNote warmup done in %.2fs (%d ctfs, %d channels)",
+            time.monotonic() - start, len(ctf_objects), len(channels))
+
+def start_warmup(channels: list):
+    global _warmup_task
+    _warmup_task = asyncio.get_event_loop().create_task(warmup(channels))
+
+async def wait_ready():
+    """
+        If the warmup is still running, wait for it instead of doing the same work in parallel.
+    """
+    if _warmup_task is not None and not _warmup_task.done():
+        await asyncio.shield(_warmup_task)
 
 async def refresh_ctf(ctx: discord_slash.SlashContext, ctfid: int = None):
     """
@@ -490,6 +672,7 @@ async def refresh_ctf(ctx: discord_slash.SlashContext, ctfid: int = None):
         The argument `ctfid` overrides this ctf-selection behaviour.
     """
     global ctfnote
+    await wait_ready()
     # make sure ctfnote exists, we can connect to it, are logged in
     if ctfnote is None or ctfnote.token is None: 
         try:
@@ -503,21 +686,26 @@ async def refresh_ctf(ctx: discord_slash.SlashContext, ctfid: int = None):
         stored_ctf_id = ctfid
         failure_msg = "Invalid ctf provided as argument."
     else:
-        botdb = (await extract_botdb(await get_pinned_ctfnote_message(ctx)))
+        botdb = await get_channel_botdb(ctx.channel)
         stored_ctf_id = (botdb or dict()).get('ctfid', None)
         failure_msg = "Invalid ctf id saved in pinned message"
 
     if stored_ctf_id is not None:
-        ctfs = await ctfnote.getCtfs()
-        ctf_meta = next(filter(lambda ctf: str(ctf['id']) == str(stored_ctf_id), ctfs), None)
+        ctf_meta = None
+        # the cached list may predate the ctf, ask again before giving up
+        for refresh in (False, True):
+            ctfs = await get_ctfs(refresh)
+            ctf_meta = next(filter(lambda ctf: str(ctf['id']) == str(stored_ctf_id), ctfs), None)
+            if ctf_meta is not None:
+                break
         if ctf_meta is None:
             await ctx.send(failure_msg)
             return None
-        return CTF(ctfnote.client, ctf_meta)
+        return ctf_object(ctf_meta)
     else:
         # if no ctf id is stored in the pinned message, we assume the first in the list of 
         # currently running CTFs is the right one
-        current_ctfs = await ctfnote.getActiveCtfs()
+        current_ctfs = await get_active_ctfs()
         if current_ctfs is None or len(current_ctfs) == 0:
             await ctx.send("No active ctf! Go on ctfnote and fix the dates!")
             return None
@@ -525,7 +713,7 @@ async def refresh_ctf(ctx: discord_slash.SlashContext, ctfid: int = None):
             await ctx.send("Multiple CTFs are currently ongoing. I was unable to infer the correct one from optional arguments and pinned messages.")
             return None
         # Just one current ctf is happening.
-        return CTF(ctfnote.client, current_ctfs[0])
+        return ctf_object(current_ctfs[0])
 
 async def update_login_info(ctx: discord_slash.SlashContext, URL_:str, admin_login_:str, admin_pass_:str):
     global URL, admin_pass, admin_login, enabled
@@ -569,11 +757,11 @@ async def update_flag(ctx: discord_slash.SlashContext, flag: str):
     current_ctf = await refresh_ctf(ctx) 
     if current_ctf is None: return
 
-    channel_name = ctx.channel.name
-    update_flag_response = await current_ctf.getTaskByChannelPin(ctx)
-    if update_flag_response is not None:
-        update_flag_response = await update_flag_response.updateFlag(flag or "")
-    return update_flag_response
+    task = await current_ctf.getTaskByChannelPin(ctx)
+    if task is not None:
+        await task.updateFlag(flag or "")
+    # the updated task, None if nothing was updated
+    return task
 
 def slugify(name:str):
     """
@@ -600,22 +788,27 @@ async def add_task(ctx: discord_slash.SlashContext, created, name: str,
     if current_ctf is None: return
     result = await current_ctf.createTask(name, category, description, flag, solved_prefix = solved_prefix)
     if ctx is not None:
-        task_id = result["createTask"]["task"]["id"]
-        task_title = result["createTask"]["task"]["title"]
-        task_pad_url = result["createTask"]["task"]["padUrl"]
+        if isinstance(result, Task):
+            # the task already existed, e.g. when retrying after the pin failed
+            task_id, task_title, task_pad_url = result.id, result.title, result.url
+        else:
+            task_id = result["createTask"]["task"]["id"]
+            task_title = result["createTask"]["task"]["title"]
+            task_pad_url = result["createTask"]["task"]["padUrl"]
         # discord trick: <URL> does not show link previews, while URL does
         ctfnote_url = "\nctfnote url: " + \
             f"<{URL}#/ctf/{current_ctf.id}-{slugify(current_ctf.name)}/task/{task_id}-{slugify(task_title)}>"
         hackmd_url = "\nhackmd (in case the other is broken): " + f"<{URL}{task_pad_url}>"
         # we need to save the ctf id somewhere to distinguish between concurrent ctfs.
         # Note: the pinned message is identified by containing the word "botdb" and "ctfnote url:".
-        botdb = json.dumps({
+        botdb = jsoncodec.dumps({
             'ctfid': current_ctf.id,
             'chalid': task_id,
-            })
+            }).decode("utf8")
         bot_data_store = f"\n||botdb:{botdb}||"
         msg = await created.send(ctfnote_url + hackmd_url + bot_data_store)
         await msg.pin()
+        channel_botdbs[created.id] = {'ctfid': current_ctf.id, 'chalid': task_id}
 
 async def register_themselves(ctx: discord_slash.SlashContext, password: str = None):
     """
@@ -632,15 +825,14 @@ async def register_themselves(ctx: discord_slash.SlashContext, password: str = N
         print(e)
         return
 
-    all_users = await ctfnote.getUsers()
     sender = ctx.author
     uid = f"{sender.name}#{sender.discriminator}"
-    user =  list(filter(lambda x: x['login'] == uid, all_users))
-    if len(user) > 0:
+    if await find_user(uid) is not None:
         await ctx.send(f"Account {uid} already exists.", hidden=True)
         return
 
     user_id, password = await ctfnote.createMemberAccount(uid, password = password)
+    invalidate("users")
     await ctx.send(f"Account {uid} was created with password {password}", hidden=True)
     
 
@@ -652,30 +844,34 @@ async def assign_player(ctx: discord_slash.SlashContext, playername):
     current_ctf = await refresh_ctf(ctx) 
     if current_ctf is None: return
 
-    all_users = await ctfnote.getUsers()
     uid = playername.name + '#' + playername.discriminator
-    user =  list(filter(lambda x: x['login'] == uid, all_users))
-    if len(user) == 0:
-        # We can make the response hidden to other players if the sender is the person who is being assigned.
-        sender = ctx.author
-        sender_fullname = f"{sender.name}#{sender.discriminator}"
-        hidden = (sender_fullname == uid)
-
+    user = await find_user(uid)
+    password = None
+    if user is None:
         user_id, password = await ctfnote.createMemberAccount(uid)
-        await ctx.send(f"Account {playername} was created with password {password}", hidden=hidden)
+        invalidate("users")
     else:
-        user_id = user[0]['id']
+        user_id = user['id']
 
     task = await current_ctf.getTaskByChannelPin(ctx)
     if task is None:
         await ctx.send("This challenge does not exist on ctfnote.")
-        return
-    for person in task.people['nodes']:
-        pid = person['profileId']
-        await task.unassignUser(pid)
-    #print(task.people)
-    await task.assignUser(user_id)
-    await ctx.send(f"Player {playername.mention} was assigned to challenge {task.title}", hidden=False)
+    else:
+        for person in task.people['nodes']:
+            pid = person['profileId']
+            await task.unassignUser(pid)
+        #print(task.people)
+        await task.assignUser(user_id)
+        await ctx.send(f"Player {playername.mention} was assigned to challenge {task.title}", hidden=False)
+
+    if password is not None:
+        # We can make the response hidden to other players if the sender is the person who is being assigned.
+        # Sent after the public response, so it is a followup of its own: the first response fills in
+        # the (public) deferred one, whatever hidden says.
+        sender = ctx.author
+        sender_fullname = f"{sender.name}#{sender.discriminator}"
+        hidden = (sender_fullname == uid)
+        await ctx.send(f"Account {playername} was created with password {password}", hidden=hidden)
 
 
 async def fixup_task(ctx: discord_slash.SlashContext,
@@ -696,6 +892,7 @@ async def fixup_task(ctx: discord_slash.SlashContext,
         # remove the pinned message if it exists
         # TODO: also move the tasks around on ctfnote? Is probably easier to have them persist and let the players handle it themselves though. Usually the fixup will be called with a channel without any not yet anyway.
         await prev_pinned_msg.delete()
+        channel_botdbs.pop(ctx.channel.id, None)
         reply_text += " Any previously used ctfnote md for this channel needs to be manually pasted over. It was not removed automatically."
 
     # Add task, with the correct ctfid
@@ -760,6 +957,8 @@ async def import_ctf_from_ctftime(ctx: discord_slash.SlashContext, ctftime_link_
         await ctx.send("That link (or ctftime event id) did not work...", hidden=hide)
         return None
 
+    invalidate("ctfs")
+    invalidate("incoming")
     if response.get('importCtf',False) == "Already present":
         await ctx.send(f"That ctf already exists. Check it in the dashboard(<{URL}>).", hidden=hide)
         return
@@ -777,7 +976,14 @@ async def get_pinned_ctfnote_message(ctx: discord_slash.SlashContext):
         pins on channel creation.
         Returns None if no matching message found.
     """
-    pins = await ctx.channel.pins() # this is a list of Message objects
+    return await get_pinned_message(ctx.channel)
+
+async def get_pinned_message(channel: discord.TextChannel):
+    """
+        Same as get_pinned_ctfnote_message, for any channel instead of the one of a command.
+    """
+    with tracing.span("pins"):
+        pins = await channel.pins() # this is a list of Message objects
     # https://discordpy.readthedocs.io/en/stable/api.html#discord.Message.content
     msg = next(filter(lambda pin: 
             'botdb:' in pin.content and
@@ -802,7 +1008,7 @@ async def extract_botdb(msg: discord.Message):
     assert len(botdb_strs) == 3
     botdb_str = botdb_strs[1][len('botdb:'):]
     try:
-        botdb = json.loads(botdb_str)
+        botdb = jsoncodec.loads(botdb_str)
     except ValueError:
         return None
     return botdb
@@ -0,0 +1,126 @@
+from . import config
+import dataclasses
+import logging
+import typing
+
+import discord                                                                  # type: ignore
+
+log = logging.getLogger("guildindex")
+
+SOLVED_PREFIX = "✓-"
+MAX_CHANNELS = 500
+
+def challenge_name(channel_name: str) -> str:
+    """
+        The challenge name for a channel, without the prefix it gets once solved.
+    """
+    if channel_name.startswith(SOLVED_PREFIX):
+        return channel_name[len(SOLVED_PREFIX):]
+    return channel_name
+
+@dataclasses.dataclass
+class Challenge:
+    channel: discord.TextChannel
+    category: str
+    name: str
+
+    @property
+    def solved(self) -> bool:
+        return self.channel.name.startswith(SOLVED_PREFIX)
+
+class GuildIndex:
+    """
+        Lookup tables for the channels of our guild, kept up to date from the channel gateway events
+        so commands don't have to scan all channels of the guild.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.channels: dict[int, discord.abc.GuildChannel] = {}
+        # category name -> category
+        self.categories: dict[str, discord.CategoryChannel] = {}
+        # category id -> channels in it
+        self.children: dict[int, dict[int, discord.abc.GuildChannel]] = {}
+        # channel id -> challenge, for the text channels in the challenge categories
+        self.challenges: dict[int, Challenge] = {}
+        self.category_ids: set[int] = set()
+        # channel id -> (category id, name) it is indexed under. discord.py updates the cached channel
+        # in place, so by the time we hear of a move or rename the channel itself only knows the new ones.
+        self.placement: dict[int, tuple[typing.Optional[int], str]] = {}
+
+    def rebuild(self, guild: discord.Guild):
+        self.clear()
+        # categories first, the challenges need to know the name of their category
+        for channel in sorted(guild.channels, key=lambda c: not isinstance(c, discord.CategoryChannel)):
+            self.add(channel)
+        log.info("Indexed %d channels, %d challenges", len(self.channels), len(self.challenges))
+
+    def add(self, channel: discord.abc.GuildChannel) -> typing.Optional[Challenge]:
+        """
+            Index (or re-index) a channel. Returns its challenge if it is a challenge channel.
+        """
+        self.remove(channel)
+        self.channels[channel.id] = channel
+        self.placement[channel.id] = (channel.category_id, channel.name)
+        if isinstance(channel, discord.CategoryChannel):
+            self.categories[channel.name] = channel
+            self.category_ids.add(channel.id)
+            self.children.setdefault(channel.id, {})
+            return None
+        if channel.category_id is not None:
+            self.children.setdefault(channel.category_id, {})[channel.id] = channel
+        category = self.channels.get(channel.category_id)
+        if (isinstance(channel, discord.TextChannel) and category is not None
+                and category.name in config.mgmt.categories):
+            chall = self.challenges[channel.id] = Challenge(channel, category.name, challenge_name(channel.name))
+            return chall
+        return None
+
+    def remove(self, channel: discord.abc.GuildChannel):
+        old = self.channels.pop(channel.id, None)
+        self.challenges.pop(channel.id, None)
+        if old is None:
+            return
+        category_id, name = self.placement.pop(channel.id)
+        if isinstance(old, discord.CategoryChannel):
+            self.category_ids.discard(old.id)
+            if self.categories.get(name) is old:
+                del self.categories[name]
+        elif category_id is not None:
+            self.children.get(category_id, {}).pop(old.id, None)
+
+    def update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        self.add(after)
+        if isinstance(after, discord.CategoryChannel) and before.name != after.name:
+            # the challenge records carry the category name
+            for channel in list(self.children.get(after.id, {}).values()):
+                self.add(channel)
+
+    def category(self, name: str) -> typing.Optional[discord.CategoryChannel]:
+        return self.categories.get(name)
+
+    def challenge(self, channel_id: int) -> Challenge:
+        return self.challenges[channel_id]
+
+    def channels_in(self, category: discord.CategoryChannel) -> list:
+        """
+            The channels in a category, in the order discord shows them.
+        """
+        return sorted(self.children.get(category.id, {}).values(), key=lambda c: c.position)
+
+    def challenge_channels(self) -> list:
+        """
+            All text channels in the challenge categories, grouped by category in config order.
+        """
+        return [chan for name in config.mgmt.categories if name in self.categories
+                for chan in self.channels_in(self.categories[name])
+                if isinstance(chan, discord.TextChannel)]
+
+    @property
+    def channel_count(self) -> int:
+        return len(self.channels)
+
+    @property
+    def category_count(self) -> int:
+        return len(self.category_ids)
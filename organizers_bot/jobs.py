@@ -0,0 +1,138 @@
+import asyncio
+import dataclasses
+import logging
+import typing
+
+import discord                                                                  # type: ignore
+
+log = logging.getLogger("jobs")
+
+@dataclasses.dataclass
+class Job:
+    key: typing.Hashable
+    description: str
+    run: typing.Callable[[], typing.Awaitable]
+    channel: typing.Optional[discord.abc.Messageable] = None
+    # sent to the channel when the job returned something truthy
+    success_msg: typing.Optional[str] = None
+    # jobs of a chain run one at a time, in the order they were submitted
+    chain: typing.Hashable = None
+    attempt: int = 0
+
+class JobQueue:
+    """
+        Runs side effects of commands (mostly ctfnote calls) in the background so the command
+        can respond right away. Failed jobs are retried with exponential backoff, and the outcome
+        is reported in the job's channel.
+
+        Jobs are deduplicated by key: submitting a job while one with the same key is still waiting
+        replaces the waiting one, e.g. only the last of several /solved in a channel is sent.
+        Jobs of the same chain (by default, with the same key) never run concurrently and run in the
+        order they were submitted, a job being retried holds up the ones after it. E.g. saving the
+        flag of a channel waits for its ctfnote task to be created.
+    """
+    def __init__(self, name: str, workers: int = 2, attempts: int = 4, backoff: float = 2.0):
+        self.log = log.getChild(name)
+        self.workers = workers
+        self.attempts = attempts
+        self.backoff = backoff
+        # chain -> its waiting jobs, oldest first
+        self.pending: dict[typing.Hashable, list[Job]] = {}
+        # chains with a job running or waiting to be retried
+        self.running: set = set()
+        self.queue: typing.Optional[asyncio.Queue] = None
+        self._tasks: list = []
+
+    def submit(self, key: typing.Hashable, description: str, run: typing.Callable[[], typing.Awaitable],
+            channel: typing.Optional[discord.abc.Messageable] = None, success_msg: typing.Optional[str] = None,
+            chain: typing.Hashable = None) -> bool:
+        """
+            Queue `run()` to be awaited by a worker. Returns False if it replaced a waiting job with the same key.
+        """
+        job = Job(key, description, run, channel, success_msg, key if chain is None else chain)
+        waiting = self.pending.get(job.chain, [])
+        for i, other in enumerate(waiting):
+            if other.key == key:
+                self.log.info("Replacing queued job %s", description)
+                waiting[i] = job
+                return False
+        self._start()
+        self.pending[job.chain] = waiting + [job]
+        self._wake(job.chain)
+        return True
+
+    @property
+    def depth(self) -> int:
+        return sum(len(waiting) for waiting in self.pending.values()) + len(self.running)
+
+    def _wake(self, chain: typing.Hashable):
+        # a chain is in the queue once while it has waiting jobs, unless the worker running it picks them up when done
+        if chain not in self.running and len(self.pending.get(chain, [])) == 1:
+            self._start().put_nowait(chain)
+
+    def _start(self) -> asyncio.Queue:
+        """
+            The queue of chains with waiting jobs, created with the workers on first use, inside the running loop.
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            loop = asyncio.get_event_loop()
+            self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+        return self.queue
+
+    async def _worker(self):
+        queue = self._start()
+        while True:
+            chain = await queue.get()
+            waiting = self.pending[chain]
+            job = waiting.pop(0)
+            if not waiting:
+                del self.pending[chain]
+            self.running.add(chain)
+            retrying = False
+            try:
+                retrying = await self._run(job)
+            finally:
+                if not retrying:
+                    self._release(chain)
+            queue.task_done()
+
+    def _release(self, chain: typing.Hashable):
+        self.running.discard(chain)
+        if chain in self.pending:
+            self._start().put_nowait(chain)
+
+    async def _run(self, job: Job) -> bool:
+        """
+            Returns whether the job will be retried.
+        """
+        job.attempt += 1
+        try:
+            result = await job.run()
+        except Exception as e:
+            if job.attempt < self.attempts:
+                delay = self.backoff * 2 ** (job.attempt - 1)
+                self.log.warning("Job %s failed (attempt %d), retrying in %.0fs", job.description, job.attempt, delay, exc_info=True)
+                asyncio.get_event_loop().call_later(delay, self._retry, job)
+                return True
+            self.log.exception("Job %s failed after %d attempts", job.description, job.attempt)
+            await self._report(job, f"Failed to {job.description}: {e}")
+            return False
+        if result and job.success_msg:
+            await self._report(job, job.success_msg)
+        return False
+
+    def _retry(self, job: Job):
+        waiting = self.pending.setdefault(job.chain, [])
+        # a newer job with the same key supersedes the retry, otherwise it goes before the jobs submitted after it
+        if not any(other.key == job.key for other in waiting):
+            waiting.insert(0, job)
+        self._release(job.chain)
+
+    async def _report(self, job: Job, msg: str):
+        if job.channel is None:
+            return
+        try:
+            await job.channel.send(msg)
+        except discord.HTTPException:
+            self.log.exception("Failed to report the result of %s", job.description)
@@ -0,0 +1,51 @@
+import json
+import logging
+import typing
+
+log = logging.getLogger("jsoncodec")
+
+# JSON for the export and the botdb, using orjson when it is installed.
+# orjson writes compact raw UTF-8 where the stdlib adds spaces and escapes, but both
+# decode to the same values, so whatever reads our output can't tell the difference.
+try:
+    import orjson                                                               # type: ignore
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+def _stdlib_dumps(obj) -> bytes:
+    return json.dumps(obj).encode("utf8")
+
+def _orjson_dumps(obj) -> bytes:
+    try:
+        # non-str keys are turned into strings like the stdlib does
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # e.g. integers beyond 64 bit or NaN, which only the stdlib handles the way we're used to
+        # (orjson.JSONEncodeError is a TypeError)
+        return _stdlib_dumps(obj)
+
+backends: dict = {"stdlib": (_stdlib_dumps, json.loads)}
+if HAVE_ORJSON:
+    backends["orjson"] = (_orjson_dumps, orjson.loads)
+
+backend: str = "orjson" if HAVE_ORJSON else "stdlib"
+_dumps, _loads = backends[backend]
+
+def use(name: str):
+    """
+        Switch the backend, e.g. to compare them or to rule one out when debugging.
+    """
+    global backend, _dumps, _loads
+    _dumps, _loads = backends[name]
+    backend = name
+    log.info("Using %s for JSON", name)
+
+def dumps(obj) -> bytes:
+    """
+        UTF-8 encoded JSON of obj.
+    """
+    return _dumps(obj)
+
+def loads(data: typing.Union[bytes, str]):
+    return _loads(data)
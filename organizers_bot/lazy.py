@@ -0,0 +1,40 @@
+import importlib
+import logging
+import threading
+import time
+import typing
+
+log = logging.getLogger("lazy")
+
+class LazyModule:
+    """
+        Stand-in for a module that is only imported on first attribute access.
+        Used for the heavy subsystems (transcript pulls in botocore, ctfnote pulls in gql)
+        that most bot invocations never touch.
+    """
+    def __init__(self, name: str, package: typing.Optional[str] = None):
+        self._name = name
+        self._package = package
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+            Import the module if that did not happen yet, and return it.
+            Safe to call from an executor thread to warm up in the background.
+        """
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.monotonic()
+                    module = importlib.import_module(self._name, self._package)
+                    log.info("Loaded %s in %.3fs", module.__name__, time.monotonic() - start)
+                    self._module = module
+        return self._module
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
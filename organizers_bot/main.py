@@ -7,6 +7,7 @@ import pathlib
 # TODO: proper CLI parsing (click?)
 def main():
     config.load(pathlib.Path("config.json"))
+    bot.startup_timer.phase("config load")
     loop = asyncio.get_event_loop()
     bot.run(loop)
     loop.run_forever()
@@ -0,0 +1,161 @@
+from . import config
+import asyncio
+import collections
+import logging
+import typing
+
+log = logging.getLogger("metrics")
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# seconds, suitable for both discord/ctfnote round trips and whole commands
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    type = "unknown"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labels
+        registry.append(self)
+
+    def samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> list:
+        return [f"# TYPE {self.name} {self.type}", f"# HELP {self.name} {self.help}"] + self.samples()
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.values: dict = collections.defaultdict(float)
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] += amount
+
+    def samples(self) -> list:
+        return [f"{self.name}_total{_labels(self.labelnames, k)} {v}" for k, v in self.values.items()]
+
+class Gauge(Metric):
+    """
+        Value is read from `fn` at scrape time, a dict of label values -> value for labelled gauges.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, fn: typing.Callable, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def samples(self) -> list:
+        value = self.fn()
+        if not self.labelnames:
+            value = {(): value}
+        return [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in value.items()]
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count]
+        self.values: dict = {}
+
+    def observe(self, value: float, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[i] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def samples(self) -> list:
+        lines = []
+        for k, entry in self.values.items():
+            for bound, count in zip(self.buckets, entry):
+                le = _labels(self.labelnames, k, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {count}")
+            le = _labels(self.labelnames, k, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {entry[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, k)} {entry[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, k)} {entry[-1]}")
+        return lines
+
+registry: list = []
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            log.exception("Failed to render metric %s", metric.name)
+    return "\n".join(lines + ["# EOF"]) + "\n"
+
+commands = Counter("bot_commands", "Slash commands by name and outcome", ("command", "outcome"))
+command_duration = Histogram("bot_command_duration_seconds", "Slash command latency", ("command",))
+graphql_requests = Counter("ctfnote_graphql_requests", "CTFNote GraphQL operations by name and outcome", ("operation", "outcome"))
+graphql_duration = Histogram("ctfnote_graphql_duration_seconds", "CTFNote GraphQL operation latency", ("operation",))
+graphql_collapsed = Counter("ctfnote_graphql_collapsed", "Reads that joined an identical request already in flight", ("operation",))
+cache_requests = Counter("ctfnote_cache_requests", "Lookups in the ctfnote caches by cache and result (hit/miss)", ("cache", "result"))
+ratelimits = Counter("discord_ratelimits", "Requests discord answered with 429")
+ratelimit_wait = Counter("discord_ratelimit_wait_seconds", "Time spent waiting for discord rate limits")
+executor_wait = Histogram("bot_command_wait_seconds", "Time commands waited for their channel or the status board", ("executor",))
+status_board_edits = Counter("bot_status_board_updates", "Status board renders by action (edit/send)", ("action",))
+export_messages = Counter("export_messages", "Messages exported")
+export_assets = Counter("export_assets", "Assets processed by the export by result (uploaded/skipped)", ("result",))
+export_bytes = Counter("export_bytes", "Bytes uploaded by the export")
+# fed by the watchdog
+loop_lag = Histogram("bot_event_loop_lag_seconds", "How late the event loop runs a scheduled callback",
+        buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+class RateLimitHandler(logging.Handler):
+    """
+        discord.py handles 429s internally and only tells us through its log, count them from there.
+    """
+    def emit(self, record: logging.LogRecord):
+        if not (isinstance(record.msg, str) and record.msg.startswith("We are being rate limited.")):
+            return
+        ratelimits.inc()
+        # the seconds discord.py waits, the first argument of the message
+        if isinstance(record.args, tuple) and record.args and isinstance(record.args[0], (int, float)):
+            ratelimit_wait.inc(amount=float(record.args[0]))
+
+async def serve():
+    """
+        Serve the metrics on config.metrics.host:port/metrics for scraping.
+    """
+    # only imported when the endpoint is enabled
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=render().encode("utf8"), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, config.metrics.host, config.metrics.port).start()
+    log.info("Serving metrics on %s:%d", config.metrics.host, config.metrics.port)
+
+def _served(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Failed to serve metrics on %s:%d", config.metrics.host, config.metrics.port, exc_info=task.exception())
+
+def start(loop: asyncio.AbstractEventLoop):
+    logging.getLogger("discord.http").addHandler(RateLimitHandler())
+    # e.g. the port is in use, the bot runs on without the endpoint
+    loop.create_task(serve()).add_done_callback(_served)
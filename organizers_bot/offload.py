@@ -0,0 +1,63 @@
+from . import config
+from . import jsoncodec
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import typing
+
+log = logging.getLogger("offload")
+
+_pool: typing.Optional[concurrent.futures.Executor] = None
+
+def pool() -> concurrent.futures.Executor:
+    global _pool
+    if _pool is None:
+        if config.offload.kind == "process":
+            _pool = concurrent.futures.ProcessPoolExecutor(config.offload.workers)
+        else:
+            _pool = concurrent.futures.ThreadPoolExecutor(config.offload.workers, thread_name_prefix="offload")
+        log.info("Offloading CPU heavy work to %d %s workers", config.offload.workers, config.offload.kind)
+    return _pool
+
+async def run(fn: typing.Callable, *args, inline: bool = False):
+    """
+        Run `fn(*args)` on the offload pool, keeping the event loop free for the gateway.
+        With `inline` it runs right here instead, for inputs too small to be worth the round trip.
+        In a process pool, `fn` and its arguments have to be picklable.
+    """
+    if inline:
+        return fn(*args)
+    return await asyncio.get_event_loop().run_in_executor(pool(), fn, *args)
+
+def _sha1_hex(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+async def sha1_hex(data: bytes) -> str:
+    return await run(_sha1_hex, data, inline=len(data) < config.offload.min_bytes)
+
+async def run_threaded(fn: typing.Callable, *args, inline: bool = False):
+    """
+        Like run, but always on a thread, for stateful objects (hashes, compressors) that don't pickle.
+    """
+    if inline:
+        return fn(*args)
+    if config.offload.kind == "process":
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+    return await run(fn, *args)
+
+async def sha1_update(h, data: bytes):
+    """
+        Feed data into the running hash h.
+    """
+    await run_threaded(h.update, data, inline=len(data) < config.offload.min_bytes)
+
+async def compress(codec, data: bytes) -> bytes:
+    return await run(codec.compress, data, inline=len(data) < config.offload.min_bytes)
+
+async def dumps_utf8(data) -> bytes:
+    """
+        UTF-8 encoded JSON of data, offloaded for lists/dicts of at least offload.min_items items.
+    """
+    small = not isinstance(data, (list, dict)) or len(data) < config.offload.min_items
+    return await run(jsoncodec.dumps, data, inline=small)
@@ -0,0 +1,127 @@
+import asyncio
+import collections
+import io
+import linecache
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+
+log = logging.getLogger("profiler")
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{frame.f_lineno})"
+
+class Sampler:
+    """
+        Statistical profiler for the thread running the event loop: a background thread takes
+        the loop thread's stack every `interval` seconds, prefixed with the coroutine of the task
+        that is running at that moment.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, loop_thread: int, interval: float = 0.005):
+        self.loop = loop
+        self.loop_thread = loop_thread
+        self.interval = interval
+        # collapsed stack ("root;...;leaf") -> samples, the input format of flamegraph tools
+        self.stacks: collections.Counter = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _task_name(self) -> str:
+        # with an explicit loop this only looks the loop up, it works from the sampling thread as well
+        task = asyncio.current_task(self.loop)
+        if task is None:
+            return "(no task)"
+        coro = task.get_coro()
+        return f"task {getattr(coro, '__qualname__', repr(coro))}"
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(self._task_name())
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def report(self, top: int = 30) -> str:
+        """
+            Functions by inclusive and self samples, and samples per task.
+        """
+        inclusive: collections.Counter = collections.Counter()
+        own: collections.Counter = collections.Counter()
+        tasks: collections.Counter = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            tasks[frames[0]] += count
+            for name in set(frames[1:]):
+                inclusive[name] += count
+            own[frames[-1]] += count
+        total = max(self.samples, 1)
+        out = io.StringIO()
+        out.write(f"{self.samples} samples every {self.interval * 1000:.0f}ms\n")
+        for title, counter in (("Tasks", tasks), ("Self", own), ("Inclusive", inclusive)):
+            out.write(f"\n{title}:\n")
+            for name, count in counter.most_common(top):
+                out.write(f"{count / total * 100:6.1f}% {count:7d}  {name}\n")
+        return out.getvalue()
+
+def memory_diff(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, top: int = 30) -> str:
+    out = io.StringIO()
+    out.write("Allocations that grew the most during the capture:\n")
+    for stat in after.compare_to(before, "lineno")[:top]:
+        frame = stat.traceback[0]
+        line = linecache.getline(frame.filename, frame.lineno).strip()
+        out.write(f"{stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks  {frame.filename}:{frame.lineno}  {line}\n")
+    return out.getvalue()
+
+async def capture(seconds: float, trace_memory: bool = False) -> dict:
+    """
+        Profile the running event loop for `seconds`. Must be awaited on that loop.
+        Returns file name -> contents of the report files.
+    """
+    loop = asyncio.get_event_loop()
+    started_tracemalloc = False
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracemalloc = True
+        before = tracemalloc.take_snapshot()
+
+    sampler = Sampler(loop, threading.get_ident())
+    start = time.monotonic()
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        await loop.run_in_executor(None, sampler.stop)
+    log.info("Profiled %.1fs, %d samples", time.monotonic() - start, sampler.samples)
+
+    files = {
+        "profile.txt": sampler.report(),
+        # feed to flamegraph.pl or speedscope
+        "profile.collapsed": sampler.collapsed(),
+    }
+    if trace_memory:
+        after = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+        files["memory.txt"] = memory_diff(before, after)
+    return files
@@ -0,0 +1,82 @@
+from . import metrics
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import functools
+import logging
+import time
+import typing
+
+log = logging.getLogger("serial")
+
+@dataclasses.dataclass
+class KeyStats:
+    runs: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+def key_label(key: typing.Hashable) -> str:
+    return " ".join(map(str, key)) if isinstance(key, tuple) else str(key)
+
+class KeyedExecutor:
+    """
+        Runs work for the same key (e.g. a channel id) one at a time, in order of arrival,
+        while work for different keys runs concurrently.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.log = log.getChild(name)
+        self.locks: dict[typing.Hashable, asyncio.Lock] = {}
+        # key -> number of holders and waiters
+        self.depth: collections.Counter = collections.Counter()
+        # key -> its waits so far; like the locks only kept while the key is busy
+        self.stats: dict[typing.Hashable, KeyStats] = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: typing.Hashable):
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+            self.stats[key] = KeyStats()
+        self.depth[key] += 1
+        start = time.monotonic()
+        try:
+            async with lock:
+                waited = time.monotonic() - start
+                stats = self.stats[key]
+                stats.runs += 1
+                stats.total_wait += waited
+                stats.max_wait = max(stats.max_wait, waited)
+                metrics.executor_wait.observe(waited, self.name)
+                if waited > 1:
+                    self.log.info("Waited %.1fs for %s", waited, key)
+                yield
+        finally:
+            self.depth[key] -= 1
+            if self.depth[key] == 0:
+                # nobody else is waiting, don't keep a lock around for every channel ever used
+                del self.depth[key]
+                del self.locks[key]
+                del self.stats[key]
+
+    def busy(self) -> dict:
+        """
+            label of each busy key -> (holders and waiters, runs, longest wait in seconds) since it got busy.
+        """
+        return {key_label(key): (self.depth[key], self.stats[key].runs, self.stats[key].max_wait) for key in self.locks}
+
+    async def run(self, key: typing.Hashable, fn: typing.Callable[[], typing.Awaitable]):
+        async with self.hold(key):
+            return await fn()
+
+def serialized(executor: KeyedExecutor, key: typing.Callable[..., typing.Hashable]):
+    """
+        Decorator: run the coroutine function through `executor`, under the key `key(*args, **kw)`.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapper(*args, **kw):
+            return await executor.run(key(*args, **kw), lambda: f(*args, **kw))
+        return wrapper
+    return decorator
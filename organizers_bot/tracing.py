@@ -0,0 +1,135 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import logging
+import time
+import typing
+
+from . import metrics
+
+log = logging.getLogger("tracing")
+
+# commands taking longer than this many seconds get their span tree logged
+SLOW_THRESHOLD = 2.0
+# how many recent durations per command the percentiles are computed over
+WINDOW = 1000
+
+class Span:
+    def __init__(self, name: str, parent: typing.Optional["Span"] = None):
+        self.name = name
+        self.children: list = []
+        self.start = time.monotonic()
+        self.end: typing.Optional[float] = None
+        if parent is not None:
+            parent.children.append(self)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.monotonic()) - self.start
+
+    def format(self, depth: int = 0) -> str:
+        lines = [f"{'  ' * depth}{self.name}: {self.duration * 1000:.0f}ms"]
+        groups: dict = collections.defaultdict(list)
+        for child in self.children:
+            groups[child.name].append(child)
+        for name, children in groups.items():
+            if len(children) == 1:
+                lines.append(children[0].format(depth + 1))
+            else:
+                # e.g. the s3 calls of an export, one line each would be unreadable
+                total = sum(c.duration for c in children)
+                slowest = max(c.duration for c in children)
+                lines.append(f"{'  ' * (depth + 1)}{name} x{len(children)}: {total * 1000:.0f}ms total, {slowest * 1000:.0f}ms max")
+        return "\n".join(lines)
+
+_current: contextvars.ContextVar = contextvars.ContextVar("span", default=None)
+# command name -> recent durations in seconds
+durations: dict = collections.defaultdict(lambda: collections.deque(maxlen=WINDOW))
+
+@contextlib.contextmanager
+def span(name: str):
+    """
+        Time the enclosed block as a child of the current span. Does nothing outside of a traced command.
+    """
+    parent = _current.get()
+    # background tasks started by a command inherit its span, but may outlive it
+    if parent is None or parent.end is not None:
+        yield None
+        return
+    s = Span(name, parent)
+    token = _current.set(s)
+    try:
+        yield s
+    finally:
+        s.end = time.monotonic()
+        _current.reset(token)
+
+def traced(name: str):
+    """
+        Decorator: trace every call of a slash command as a root span named after the command.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapper(*args, **kw):
+            root = Span(f"/{name}")
+            token = _current.set(root)
+            outcome = "error"
+            try:
+                result = await f(*args, **kw)
+                outcome = "ok"
+                return result
+            finally:
+                root.end = time.monotonic()
+                _current.reset(token)
+                durations[name].append(root.duration)
+                metrics.commands.inc(name, outcome)
+                metrics.command_duration.observe(root.duration, name)
+                if root.duration > SLOW_THRESHOLD:
+                    log.warning("Slow command:\n%s", root.format())
+        return wrapper
+    return decorator
+
+def instrument_http(http):
+    """
+        Add a span for every discord REST request made through the discord.py HTTPClient `http`.
+    """
+    request = http.request
+
+    @functools.wraps(request)
+    async def traced_request(route, **kw):
+        with span(f"discord {route.method} {route.path}"):
+            return await request(route, **kw)
+    http.request = traced_request
+
+def instrument(obj, methods: list, prefix: str):
+    """
+        Add a span for every call of the given coroutine methods of `obj`, e.g. the calls of an s3 client.
+    """
+    for name in methods:
+        method = getattr(obj, name)
+
+        def make(method, label):
+            @functools.wraps(method)
+            async def traced_method(*args, **kw):
+                with span(label):
+                    return await method(*args, **kw)
+            return traced_method
+        setattr(obj, name, make(method, f"{prefix} {name}"))
+
+def percentile(values: list, p: float) -> float:
+    """
+        Nearest-rank percentile of sorted `values`.
+    """
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def summary() -> dict:
+    """
+        command name -> (calls in the window, p50, p95, p99) in seconds
+    """
+    result = {}
+    for name, values in durations.items():
+        ordered = sorted(values)
+        if ordered:
+            result[name] = (len(ordered), percentile(ordered, 50), percentile(ordered, 95), percentile(ordered, 99))
+    return result
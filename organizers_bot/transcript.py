@@ -1,7 +1,14 @@
 from . import config
+from . import tracing
+from . import metrics
+from . import offload
+from . import assetindex
+from . import transfer
+from . import jsoncodec
+from . import compression
+from . import transcriptreader
 import logging
 import discord
-import discord.iterators
 import discord.http
 import discord_slash
 import asyncio
@@ -9,78 +16,202 @@ import aiohttp
 import os
 from urllib import parse
 import hashlib
-import copy
+import functools
 import json
 import aiobotocore
 import aiobotocore.client
+import botocore.exceptions
 import hashlib
 import hmac
 import json
+import typing
 import urllib
 
 log = logging.getLogger("transcript")
 
-class JSONHistoryIterator(discord.iterators.HistoryIterator):
-    async def flatten(self):
-        # this is similar to fill_messages except it uses a list instead
-        # of a queue to place the messages in.
-        result = []
-        channel = await self.messageable._get_channel()
-        self.channel = channel
-        while self._get_retrieve():
-            data = await self._retrieve_messages(self.retrieve)
-            if len(data) < 100:
-                self.limit = 0 # terminate the infinite loop
-
-            if self.reverse:
-                data = reversed(data)
-            if self._filter:
-                data = filter(self._filter, data)
-
-            for element in data:
-                result.append((self.state.create_message(channel=channel, data=element), element))
-        return result
-
-    async def fill_messages(self):
-        if not hasattr(self, 'channel'):
-            # do the required set up
-            channel = await self.messageable._get_channel()
-            self.channel = channel
-
-        if self._get_retrieve():
-            data = await self._retrieve_messages(self.retrieve)
-            if len(data) < 100:
-                self.limit = 0 # terminate the infinite loop
-
-            if self.reverse:
-                data = reversed(data)
-            if self._filter:
-                data = filter(self._filter, data)
-
-            channel = self.channel
-            for element in data:
-                await self.messages.put((self.state.create_message(channel=channel, data=element), element))
-
-def json_history(mable: discord.abc.Messageable, limit=10000, before=None, after=None, around=None, oldest_first=None):
-    return JSONHistoryIterator(mable, limit=limit, before=before, after=after, around=around, oldest_first=oldest_first)
+async def raw_history(http: discord.http.HTTPClient, channel_id: int, after: int = 0) -> typing.AsyncIterator[dict]:
+    """
+        The raw message payloads of a channel, oldest first. Unlike channel.history() this
+        builds no discord.Message for them, which the export doesn't need.
+    """
+    # one page after the other: discord.py holds the rate limit bucket of the channel for the whole
+    # request, so concurrent requests for the same channel would only queue up behind each other
+    while True:
+        # the 100 messages after `after`, newest first
+        data = await http.logs_from(channel_id, 100, after=after)
+        for element in reversed(data):
+            yield element
+        if len(data) < 100:
+            return
+        after = int(data[0]["id"])
+
+CDN = "https://cdn.discordapp.com"
+
+def avatar_url(user: dict) -> str:
+    """
+        The url discord.py's avatar_url_as(static_format="png") gives for a user payload.
+    """
+    if user.get("avatar") is None:
+        return f"{CDN}/embed/avatars/{int(user['discriminator']) % 5}.png"
+    fmt = "gif" if user["avatar"].startswith("a_") else "png"
+    return f"{CDN}/avatars/{user['id']}/{user['avatar']}.{fmt}?size=1024"
+
+def emoji_url(emoji: dict) -> str:
+    fmt = "gif" if emoji.get("animated") else "png"
+    return f"{CDN}/emojis/{emoji['id']}.{fmt}"
+
+# pipelines of the exports in progress, for the queue depth gauge
+running: set = set()
+
+metrics.Gauge("export_queue_depth", "Items waiting between the stages of the export", lambda: {
+    ("transfers",): sum(p.transfers.qsize() for p in running),
+    ("writer",): sum(q.qsize() for p in running for q in p.pending),
+}, ("stage",))
+
+class Pipeline:
+    """
+        The stages of an export: history fetch -> asset extraction -> transfer workers -> JSON writer,
+        connected by bounded queues. The history of up to export.channels channels is fetched at once,
+        and the assets of all of them share export.transfers workers, so one channel with lots of
+        attachments still has them transferred in parallel.
+    """
+    def __init__(self, mgr: "TranscriptManager", s3) -> None:
+        self.mgr = mgr
+        self.s3 = s3
+        self.transfers: asyncio.Queue = asyncio.Queue(config.export.queue_size)
+        self.channels = asyncio.Semaphore(config.export.channels)
+        # per channel: messages waiting for their assets to be written
+        self.pending: list[asyncio.Queue] = []
+        # the tasks in export_channel, they need the workers until they are done
+        self.exporting: set[asyncio.Task] = set()
+        self.workers: list[asyncio.Task] = []
+
+    async def __aenter__(self):
+        self.workers = [asyncio.create_task(self.transfer_worker()) for _ in range(config.export.transfers)]
+        running.add(self)
+        return self
+
+    async def __aexit__(self, *exc):
+        running.discard(self)
+        # whatever channel is still exporting, e.g. when we got cancelled, would wait on its assets forever
+        exporting = list(self.exporting)
+        for task in exporting:
+            task.cancel()
+        await asyncio.gather(*exporting, return_exceptions=True)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    async def transfer_worker(self):
+        while True:
+            job, fut = await self.transfers.get()
+            # the channel it belongs to failed
+            if fut.done():
+                continue
+            try:
+                result = await job()
+                if not fut.done():
+                    fut.set_result(result)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+
+    async def fetch(self, channel: discord.TextChannel, pending: asyncio.Queue, after: int):
+        loop = asyncio.get_event_loop()
+        try:
+            async for data in raw_history(self.mgr.bot.http, channel.id, after):
+                # path in data -> archived url, filled in by the jobs
+                overlay: dict[tuple, str] = {}
+                futures = []
+                for job in self.mgr.asset_jobs(data, overlay, self.s3):
+                    fut = loop.create_future()
+                    await self.transfers.put((job, fut))
+                    futures.append(fut)
+                await pending.put((data, overlay, futures))
+        except Exception as e:
+            # hand it to the writer
+            await pending.put(e)
+            return
+        await pending.put(None)
+
+    async def export_channel(self, channel: discord.TextChannel, write: typing.Callable, after: int = 0):
+        """
+            Awaits write(message, overlay) for every message of channel after the id `after`,
+            oldest first, once all its assets are saved. overlay maps paths in message to archived urls.
+        """
+        task = asyncio.current_task()
+        assert task is not None
+        self.exporting.add(task)
+        try:
+            async with self.channels:
+                await self._export_channel(channel, write, after)
+        finally:
+            self.exporting.discard(task)
+
+    async def _export_channel(self, channel: discord.TextChannel, write: typing.Callable, after: int):
+        pending: asyncio.Queue = asyncio.Queue(config.export.queue_size)
+        self.pending.append(pending)
+        fetcher = asyncio.create_task(self.fetch(channel, pending, after))
+        futures = []
+        try:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                data, overlay, futures = item
+                await asyncio.gather(*futures)
+                await write(data, overlay)
+                metrics.export_messages.inc()
+        finally:
+            fetcher.cancel()
+            self.pending.remove(pending)
+            # don't transfer what nobody will write anymore
+            for fut in futures:
+                fut.cancel()
+            while not pending.empty():
+                item = pending.get_nowait()
+                if isinstance(item, tuple):
+                    for fut in item[2]:
+                        fut.cancel()
 
 class TranscriptManager:
     def __init__(self, bot: discord.Client) -> None:
         self.log = log.getChild("manager")
         self.bot = bot
-        self.session = aiohttp.ClientSession()
-        self.existing_assets = set()
-
-    async def create(self, category: discord.CategoryChannel, ctx: discord_slash.SlashContext):
+        # also caps the connections to discord's CDN
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=config.export.transfers))
+        self.index = assetindex.AssetIndex()
+        # of the transcript JSON, None to store it as is
+        self.codec = compression.get(config.export.compression)
+        # exports share the index, which is loaded and saved as a whole
+        self.exporting = asyncio.Lock()
+        # asset paths being downloaded by this export, so every avatar is fetched once
+        self.saving: set[str] = set()
+        # url -> its download in this export, for urls that are in many messages (stickers)
+        self.downloads: dict[str, asyncio.Future] = {}
+
+    async def create(self, category: discord.CategoryChannel, ctx: discord_slash.SlashContext, full: bool = False):
         session = aiobotocore.get_session()
         async with session.create_client('s3',
                 endpoint_url='https://s3.us-west-002.backblazeb2.com',
                 aws_access_key_id = config.s3.keyID,
                 aws_secret_access_key = config.s3.key) as s3:
-            self.log.info("Creating transcript for %s", category.name)
-            trans = Transcript(self, category, ctx)
-            await trans.build(s3)
-            await trans.sync_to_archive()
+            tracing.instrument(s3, ["get_object", "list_object_versions", "delete_object", "put_object", "copy_object",
+                    "create_multipart_upload", "upload_part", "upload_part_copy", "complete_multipart_upload",
+                    "abort_multipart_upload"], "s3")
+            async with self.exporting:
+                await self.index.load(s3)
+                self.log.info("Creating transcript for %s", category.name)
+                trans = Transcript(self, category, ctx, full)
+                try:
+                    await trans.build(s3)
+                finally:
+                    self.saving.clear()
+                    self.downloads.clear()
+                    await self.index.save(s3)
+                await trans.sync_to_archive()
 
     def get_target_path(self, url: str) -> str:
         discord_parsed = parse.urlparse(url)
@@ -88,39 +219,130 @@ class TranscriptManager:
         target_path = os.path.join("assets", target_path)
         return target_path
 
-    async def save_contents(self, target_path: str, contents: bytes, s3):
-        sha1 = hashlib.sha1(contents).hexdigest()
-        # delete any pre-existing assets.
-        existing_ok = False
+    def get_content_path(self, url: str, sha1: str) -> str:
+        """
+            Assets are stored under the hash of their content: identical files are stored once,
+            and different files never overwrite each other. The extension stays for the archive site.
+        """
+        ext = os.path.splitext(parse.urlparse(url).path)[1].lower()
+        return os.path.join("assets", "sha1", sha1[:2], sha1 + ext)
+
+    async def save_content_addressed(self, url: str, contents: bytes, s3) -> str:
+        """
+            Upload contents downloaded from url under its content hash, unless that is stored already.
+            Returns the path it is stored at.
+        """
+        sha1 = await offload.sha1_hex(contents)
+        target_path = self.get_content_path(url, sha1)
+        entry = self.index.get(target_path)
+        if entry is not None:
+            self.log.info("Already have %s as %s", url, target_path)
+            metrics.export_assets.inc("skipped")
+            self.index.add(target_path, sha1, entry["size"], entry["etag"], url)
+            return target_path
+        self.log.info("Saving %s to %s", url, target_path)
+        await self.put(target_path, contents, sha1, s3, url)
+        return target_path
+
+    async def put(self, target_path: str, contents: bytes, sha1: str, s3, url: typing.Optional[str] = None, headers: typing.Optional[dict] = None):
+        resp = await s3.put_object(Bucket=config.s3.bucket_name, Key=target_path, Body=contents, Metadata={"sha1" : sha1},
+                **(headers or {}))
+        self.index.add(target_path, sha1, len(contents), resp.get("ETag"), url)
+        metrics.export_assets.inc("uploaded")
+        metrics.export_bytes.inc(amount=len(contents))
+
+    async def save_contents(self, target_path: str, contents: bytes, s3, headers: typing.Optional[dict] = None):
+        sha1 = await offload.sha1_hex(contents)
+        existing = self.index.get(target_path)
+        if existing is not None and existing["sha1"] == sha1:
+            self.log.info("Found existing one: %s (%s)", target_path, sha1)
+            metrics.export_assets.inc("skipped")
+            return
         self.log.info("Saving asset to %s", target_path)
-        response: dict = await s3.list_objects_v2(Bucket=config.s3.bucket_name, Prefix=target_path)
-        for existing in response.get("Contents", []):
-            # self.log.info("Have existing %s", existing)
-            key = existing["Key"]
-            obj = await s3.head_object(
-                Bucket=config.s3.bucket_name,
-                Key=key
-            )
-            # self.log.info("Have existing obj: %s", obj)
-            existing_sha1 = None
-            if "Metadata" in obj:
-                if "sha1" in obj["Metadata"]:
-                    existing_sha1 = obj["Metadata"]["sha1"]
-            if existing_sha1 != sha1:
-                self.log.info("Deleting out of date %s", target_path)
-                versions: dict = await s3.list_object_versions(
-                    Bucket=config.s3.bucket_name,
-                    Prefix=target_path
-                )
-                for version in versions.get("Versions", []) + versions.get("DeleteMarkers", []):
-                    await s3.delete_object(Bucket=config.s3.bucket_name, Key=key, VersionId=version["VersionId"])
-            else:
-                self.log.info("Found existing one: %s (%s, %s)", target_path, existing_sha1, sha1)
-                return key
+        if existing is not None:
+            # delete any pre-existing versions.
+            self.log.info("Deleting out of date %s", target_path)
+            await self.delete_versions(target_path, s3)
+        await self.put(target_path, contents, sha1, s3, headers=headers)
+
+    async def delete_versions(self, target_path: str, s3, keep: typing.Optional[str] = None):
+        """
+            Delete all versions of target_path except `keep`.
+        """
+        versions: dict = await s3.list_object_versions(
+            Bucket=config.s3.bucket_name,
+            Prefix=target_path
+        )
+        for version in versions.get("Versions", []) + versions.get("DeleteMarkers", []):
+            if version["Key"] == target_path and version["VersionId"] != keep:
+                await s3.delete_object(Bucket=config.s3.bucket_name, Key=target_path, VersionId=version["VersionId"])
+
+    async def save_stream(self, url: str, stream: aiohttp.StreamReader, s3, target_path: typing.Optional[str] = None,
+            size: typing.Optional[int] = None) -> str:
+        """
+            Save what is read from stream, downloaded from url, to target_path or under its content hash.
+            Only one part of it is in memory at a time, counted against the export's memory budget
+            (only as much as is left of it when its size is known): anything that fits a single part
+            is uploaded as usual, anything larger goes up part by part in a multipart upload.
+            Without target_path that goes to a temporary key, which is copied to the content hash
+            once the hash is known. Returns the path it is stored at.
+        """
+        budget = transfer.budget()
+        part_size = config.s3.part_size
+        upload: typing.Optional[transfer.Upload] = None
+        try:
+            while True:
+                done = upload.size if upload is not None else 0
+                left = size - done if size is not None and size > done else part_size
+                async with budget.hold(min(left, part_size)):
+                    part = await transfer.read_part(stream, part_size)
+                    if upload is None and len(part) < part_size:
+                        # fits in a single request
+                        if target_path is None:
+                            return await self.save_content_addressed(url, part, s3)
+                        await self.save_contents(target_path, part, s3)
+                        return target_path
+                    if not part:
+                        break
+                    if upload is None:
+                        upload = transfer.Upload(s3, target_path or transfer.temp_key())
+                    await upload.add(part)
+                if len(part) < part_size:
+                    break
+            # anything that didn't fill the first part returned above
+            assert upload is not None
+            completed = await upload.complete()
+        except BaseException:
+            if upload is not None:
+                await upload.abort()
+            raise
+        metrics.export_assets.inc("uploaded")
+        sha1 = upload.sha1.hexdigest()
+        etag = completed.get("ETag")
+        if target_path is not None:
+            self.index.add(target_path, sha1, upload.size, etag, url)
+            return target_path
 
-        await s3.put_object(Bucket=config.s3.bucket_name, Key=target_path, Body=contents, Metadata={"sha1" : sha1})
+        target_path = self.get_content_path(url, sha1)
+        try:
+            existing = self.index.get(target_path)
+            if existing is None:
+                self.log.info("Saving %s to %s", url, target_path)
+                resp = await s3.copy_object(Bucket=config.s3.bucket_name, Key=target_path,
+                        CopySource={"Bucket": config.s3.bucket_name, "Key": upload.key},
+                        MetadataDirective="REPLACE", Metadata={"sha1": sha1})
+                etag = resp.get("CopyObjectResult", {}).get("ETag")
+            else:
+                self.log.info("Already have %s as %s", url, target_path)
+                etag = existing["etag"]
+            self.index.add(target_path, sha1, upload.size, etag, url)
+        finally:
+            # the bucket is versioned: without the version this would only add a delete marker on top of it
+            version = completed.get("VersionId")
+            await s3.delete_object(Bucket=config.s3.bucket_name, Key=upload.key, **({"VersionId": version} if version else {}))
+        return target_path
 
-    async def save_asset(self, discord_url: discord.Asset, s3) -> str:
+    async def save_asset(self, discord_url: str, s3) -> str:
         """Save an asset found at discord_url to assets/path_from_discord_url.
         Returns the URL to access the asset at.
 
@@ -136,100 +358,217 @@ class TranscriptManager:
         str
             [description]
         """
-        # no need to download again!
-        target_path = self.get_target_path(discord_url._url)
-        if target_path in self.existing_assets:
+        # no need to download again! avatars and emojis never change under the same path.
+        target_path = self.get_target_path(discord_url)
+        if target_path in self.saving or self.index.get(target_path) is not None:
+            metrics.export_assets.inc("skipped")
             return target_path
-        self.existing_assets.add(target_path)
+        self.saving.add(target_path)
         
         # self.log.info("Uploading from %s to %s", discord_url, target_path)
-        # response = self.session.get(discord_url)
-        contents = await discord_url.read()
-        await self.save_contents(target_path, contents, s3)
+        try:
+            async with self.session.get(discord_url) as resp:
+                resp.raise_for_status()
+                await self.save_stream(discord_url, resp.content, s3, target_path, transfer.body_size(resp))
+        except BaseException:
+            # not saved after all, let a later reference try again
+            self.saving.discard(target_path)
+            raise
         return target_path
 
-    async def save_url(self, url: str, s3, target_path=None) -> str:
-        if target_path is None:
-            target_path = self.get_target_path(url)
-        if target_path in self.existing_assets:
-            return target_path
-        self.existing_assets.add(target_path)
+    async def save_url(self, url: str, s3) -> str:
+        """
+            Save the file at url under its content hash. Returns the path to use instead of url.
+        """
+        known = self.index.key_for_url(url)
+        if known is not None:
+            metrics.export_assets.inc("skipped")
+            return known
+        if url not in self.downloads:
+            self.downloads[url] = asyncio.ensure_future(self.download(url, s3))
+        return await asyncio.shield(self.downloads[url])
+
+    async def download(self, url: str, s3) -> str:
         async with self.session.get(url) as resp:
             if resp.status in [404, 401, 403, 415]:
                 return url
             resp.raise_for_status()
-            contents = await resp.content.read()
-            log.info("Downloaded contents %s: %d", url, len(contents))
-            await self.save_contents(target_path, contents, s3)
-            return target_path
+            return await self.save_stream(url, resp.content, s3, size=transfer.body_size(resp))
+
+    async def _set_url(self, url: str, s3, overlay: dict, *paths: tuple):
+        new_url = await self.save_url(url, s3)
+        for path in paths:
+            overlay[path] = new_url
 
-    async def save_msg_contents(self, message: discord.message.Message, msg: dict, s3) -> dict:
-        """Saves any contents found in message and changes the url if need be.
+    async def _set_asset_url(self, url: str, s3, overlay: dict, path: tuple):
+        overlay[path] = await self.save_asset(url, s3)
+
+    def asset_jobs(self, msg: dict, overlay: dict, s3) -> list:
+        """Finds the contents of the message payload msg that we save ourselves.
 
         Parameters
         ----------
         msg : dict
-            [description]
+            The raw message, left untouched.
+        overlay : dict
+            Where the jobs put the new urls, by their path in msg.
 
         Returns
         -------
-        dict
-            [description]
+        list
+            Coroutine functions that each save one of them.
         """
-        author: discord.User = message.author
-        await self.save_asset(author.avatar_url_as(static_format="png"), s3)
+        jobs = [functools.partial(self.save_asset, avatar_url(msg["author"]), s3)]
         #todo save emojis!
-        if "sticker_items" in msg:
-            for idx, sticker in enumerate(msg["sticker_items"]):
-                # log.info("Have sticker: %s, %s", sticker, sticker.image_url_as())
-                url = f"https://media.discordapp.net/stickers/{sticker['id']}.png?size=256&passthrough=false"
-                new_url = await self.save_url(url, s3)
-                msg["sticker_items"][idx]["url"] = new_url
-        for idx, attachment in enumerate(message.attachments):
-            new_url = await self.save_url(attachment.url, s3)
-            msg["attachments"][idx]["proxy_url"] = new_url
-            msg["attachments"][idx]["url"] = new_url
-        for idx, embed in enumerate(message.embeds):
-            embed: discord.Embed
-            provider = embed.provider.name
-            if provider is discord.Embed.Empty:
-                provider = "unknown"
-            # log.info("Saving embed %s", embed)
-            url_parsed = parse.urlparse(embed.url)
-            base_path = os.path.basename(url_parsed.path)
-            target_path = os.path.join("assets", "embeds", provider)
-            # log.info("Target path: %s", target_path)
-            # log.info("Video: %s. Thumb: %s. Image: %s", embed.video.url, embed.thumbnail.proxy_url, embed.image.proxy_url)
-            embed_dict = msg["embeds"][idx]
-            if embed.video.url is not discord.Embed.Empty:
-                video_path = os.path.join(target_path, "video.mp4")
-                new_url = await self.save_url(embed.video.url, s3, video_path)
-                embed_dict["video"]["url"] = new_url
-            if embed.thumbnail.proxy_url is not discord.Embed.Empty:
-                new_url = await self.save_url(embed.thumbnail.proxy_url, s3, os.path.join(target_path, "thumbnail.png"))
-                embed_dict["thumbnail"]["url"] = new_url
-                embed_dict["thumbnail"]["proxy_url"] = new_url
-            if embed.image.proxy_url is not discord.Embed.Empty:
-                # self.log.info("Embed image: %s", embed.image)
-                new_url = await self.save_url(embed.image.proxy_url, s3, os.path.join(target_path, "image.png"))
-                embed_dict["image"]["url"] = new_url
-                embed_dict["image"]["proxy_url"] = new_url
-            msg["embeds"][idx] = embed_dict
-        for idx, reaction in enumerate(message.reactions):
-            if reaction.custom_emoji:
-                new_url = await self.save_asset(reaction.emoji.url_as(), s3)
-                msg["reactions"][idx]["emoji"]["url"] = new_url
-        return msg
+        for idx, sticker in enumerate(msg.get("sticker_items", [])):
+            url = f"https://media.discordapp.net/stickers/{sticker['id']}.png?size=256&passthrough=false"
+            jobs.append(functools.partial(self._set_url, url, s3, overlay, ("sticker_items", idx, "url")))
+        for idx, attachment in enumerate(msg.get("attachments", [])):
+            jobs.append(functools.partial(self._set_url, attachment["url"], s3, overlay,
+                    ("attachments", idx, "proxy_url"), ("attachments", idx, "url")))
+        for idx, embed in enumerate(msg.get("embeds", [])):
+            if embed.get("video", {}).get("url"):
+                jobs.append(functools.partial(self._set_url, embed["video"]["url"], s3, overlay, ("embeds", idx, "video", "url")))
+            for kind in ("thumbnail", "image"):
+                if embed.get(kind, {}).get("proxy_url"):
+                    jobs.append(functools.partial(self._set_url, embed[kind]["proxy_url"], s3, overlay,
+                            ("embeds", idx, kind, "url"), ("embeds", idx, kind, "proxy_url")))
+        for idx, reaction in enumerate(msg.get("reactions", [])):
+            if reaction["emoji"].get("id") is not None:
+                jobs.append(functools.partial(self._set_asset_url, emoji_url(reaction["emoji"]), s3, overlay,
+                        ("reactions", idx, "emoji", "url")))
+        return jobs
+
+    def message_writer(self, filepath: str, s3, resume: typing.Optional[tuple] = None) -> "MessageWriter":
+        return MessageWriter(self, filepath, s3, resume)
+
+    def rewrite_writer(self, filepath: str, s3, resume: typing.Optional[tuple] = None) -> "RewriteWriter":
+        return RewriteWriter(self, filepath, s3, resume)
+
+    async def load_json(self, filepath: str, s3):
+        """
+            The JSON stored at filepath, or None if the index doesn't know it.
+        """
+        if self.index.get(filepath) is None:
+            return None
+        try:
+            resp = await s3.get_object(Bucket=config.s3.bucket_name, Key=filepath)
+            return jsoncodec.loads(compression.decompress(await resp["Body"].read(), resp.get("ContentEncoding")))
+        except botocore.exceptions.ClientError as e:
+            if not assetindex.is_missing(e):
+                raise
+            return None
+
+    def json_headers(self, content_type: str = "application/json") -> dict:
+        headers = {"ContentType": content_type}
+        if self.codec is not None:
+            headers["ContentEncoding"] = self.codec.name
+        return headers
 
     async def save_json(self, data, filepath, s3):
         # self.log.info("Saving json to %s", filepath)
-        json_data = json.dumps(data).encode("utf8")
-        await self.save_contents(filepath, json_data, s3)
+        json_data = await offload.dumps_utf8(data)
+        if self.codec is not None:
+            json_data = await offload.compress(self.codec, json_data)
+        await self.save_contents(filepath, json_data, s3, self.json_headers())
+
+
+class ItemWriter:
+    """
+        Streams the items of a JSON collection to s3 as they are exported, in the format of export.format:
+        a JSON array/object, or NDJSON (one item per line). Only the part being uploaded is held in memory,
+        however long the channel. The subclasses say what an item is.
+        With `resume` (the item count, size, trailer and compressor state of what is stored already),
+        items are appended to it. The trailer is what has to be cut off to append: the closing bracket
+        and, when compressed, the end of the gzip member / zstd frame.
+    """
+    OPEN, CLOSE = b"[", b"]"
+
+    def __init__(self, mgr: TranscriptManager, filepath: str, s3, resume: typing.Optional[tuple] = None) -> None:
+        self.mgr = mgr
+        self.filepath = filepath
+        self.s3 = s3
+        self.ndjson = config.export.format == "ndjson"
+        self.count, self.stored, self.trailer, self.state = resume or (0, 0, 0, None)
+        self.written = 0
+        self.headers = mgr.json_headers("application/x-ndjson" if self.ndjson else "application/json")
+        self.stream = transfer.StreamWriter(s3, filepath, self.save_small, mgr.codec, self.headers)
+
+    async def save_small(self, contents: bytes):
+        await self.mgr.save_contents(self.filepath, contents, self.s3, self.headers)
+
+    async def append(self, data: bytes):
+        """
+            Add one encoded item.
+        """
+        if self.written == 0 and self.count:
+            await self.stream.keep(self.stored - self.trailer, self.state)
+        self.written += 1
+        if self.ndjson:
+            data += b"\n"
+        else:
+            data = (b"," if self.count else self.OPEN) + data
+        self.count += 1
+        await self.stream.write(data)
 
+    def checkpoint(self) -> dict:
+        """
+            What resuming needs to know about the stored file, once closed.
+        """
+        entry = self.mgr.index.get(self.filepath)
+        if entry is None:
+            raise RuntimeError(f"{self.filepath} was not stored")
+        return {"size": entry["size"], "trailer": self.trailer, "count": self.count, "state": self.state}
+
+    async def close(self):
+        if self.count and not self.written:
+            # resumed without anything new
+            return
+        await self.stream.cut()
+        self.state = self.stream.state()
+        before = self.stream.size
+        if not self.ndjson:
+            await self.stream.write(self.CLOSE if self.count else self.OPEN + self.CLOSE)
+        resp = await self.stream.close()
+        self.trailer = self.stream.size - before
+        if resp is None:
+            return
+        # the multipart upload hashed it along the way, unless it copied the stored part
+        upload = self.stream.upload
+        sha1 = upload.sha1.hexdigest() if upload.hashed else None
+        metrics.export_assets.inc("uploaded")
+        self.mgr.index.add(self.filepath, sha1, upload.size, resp.get("ETag"))
+        await self.mgr.delete_versions(self.filepath, self.s3, keep=resp.get("VersionId"))
+
+    async def abort(self):
+        await self.stream.abort()
+
+class MessageWriter(ItemWriter):
+    """
+        Streams the messages of a channel: a JSON array, the shape of messages.json, or NDJSON.
+    """
+    async def write(self, msg: dict):
+        await self.append(jsoncodec.dumps(msg))
+
+class RewriteWriter(ItemWriter):
+    """
+        Streams the rewrite map of a channel (see transcriptreader): a JSON object of message id -> rewrites,
+        or with NDJSON one {"id": ..., "rewrites": {...}} per line. Only messages with rewrites are in it.
+    """
+    OPEN, CLOSE = b"{", b"}"
+
+    async def write_overlay(self, msg_id: str, overlay: dict):
+        rewrites = {transcriptreader.path_key(path): url for path, url in overlay.items()}
+        if self.ndjson:
+            await self.append(jsoncodec.dumps({"id": msg_id, "rewrites": rewrites}))
+        else:
+            await self.append(jsoncodec.dumps(msg_id) + b":" + jsoncodec.dumps(rewrites))
 
 class Transcript:
-    def __init__(self, mgr: TranscriptManager, category: discord.CategoryChannel, ctx: discord_slash.SlashContext) -> None:
+    def __init__(self, mgr: TranscriptManager, category: discord.CategoryChannel, ctx: discord_slash.SlashContext, full: bool = False) -> None:
         self.log = log.getChild("maker")
+        # ignore the checkpoints and export everything again, e.g. to pick up edited messages
+        self.full = full
         self.category = category
         self.mgr = mgr
         self.ctx = ctx
@@ -257,40 +596,84 @@ class Transcript:
         else:
             await self.status_msg.edit(content=status_msg)
 
-    async def build_messages(self, channel: discord.TextChannel, s3) -> list:
-        """Builds a list of message json objects, that are found inside channel.
-        It also downloads any found attachments to s3 and replaces the links to them.
+    async def build_messages(self, channel: discord.TextChannel, pipeline: Pipeline, s3) -> None:
+        """Exports the messages of channel to s3, streamed as they are fetched: the messages
+        discord sent (messages.orig.json) and the archived view (messages.json), or with
+        export.single_copy the rewrite map (rewrites.json) instead. Attachments and other
+        assets are saved to s3 along the way, the archived urls point at them.
+
+        Afterwards checkpoint.json records the last message id and, per file, its size,
+        trailer and compressor state. The next export of the channel appends the messages
+        after that id to the stored files, unless it is a full export or they changed since.
 
         Parameters
         ----------
         channel : discord.TextChannel
             The channel where to build from.            
-
-        Returns
-        -------
-        list
-            List of message json objects.
+        pipeline : Pipeline
+            The pipeline of this export.
         """
         try:
             channel_folder = os.path.join(self.json_folder, channel.name)
             self.log.info("Building messages for channel %s, %s", channel.name, type(channel._state))
             await self.update_status(f"Exporting {channel.name}")
-            message: discord.message.Message
-            og_msgs = []
-            changed_msgs = []
             channel_meta = os.path.join(channel_folder, "meta.json")
             channel_json = await self.http.get_channel(channel.id)
             await self.mgr.save_json(channel_json, channel_meta, s3)
-            async for item in json_history(channel, oldest_first=True):
-                message, data = item
-                # self.log.info("Retrieved message: %s (%s)", message, data)
-                changed = await self.mgr.save_msg_contents(message, copy.deepcopy(data), s3)
-                changed_msgs.append(changed)
-                og_msgs.append(data)
-            messages_path = os.path.join(channel_folder, "messages.json")
-            await self.mgr.save_json(changed_msgs, messages_path, s3)
-            orig_path = os.path.join(channel_folder, "messages.orig.json")
-            await self.mgr.save_json(og_msgs, orig_path, s3)
+
+            ext = "ndjson" if config.export.format == "ndjson" else "json"
+            messages_path = os.path.join(channel_folder, f"messages.{ext}")
+            orig_path = os.path.join(channel_folder, f"messages.orig.{ext}")
+            rewrites_path = os.path.join(channel_folder, f"rewrites.{ext}")
+            paths = [orig_path, rewrites_path] if config.export.single_copy else [messages_path, orig_path]
+            checkpoint_path = os.path.join(channel_folder, "checkpoint.json")
+            checkpoint = None if self.full else await self.mgr.load_json(checkpoint_path, s3)
+            if checkpoint is not None and not self.matches(checkpoint, paths):
+                self.log.info("Checkpoint of %s doesn't match what is stored, exporting it all", channel.name)
+                checkpoint = None
+            after, count = 0, 0
+            resume = {}
+            if checkpoint is not None:
+                after, count = int(checkpoint["last_id"]), checkpoint["count"]
+                resume = {path: (f["count"], f["size"], f["trailer"], f.get("state")) for path, f in checkpoint["files"].items()}
+                self.log.info("Resuming %s after message %d (%d exported)", channel.name, after, count)
+            og_msgs = self.mgr.message_writer(orig_path, s3, resume.get(orig_path))
+            # the archived view, or the rewrite map that turns the originals into it
+            rewrites: typing.Optional[RewriteWriter] = None
+            archived: typing.Optional[MessageWriter] = None
+            second: ItemWriter
+            if config.export.single_copy:
+                second = rewrites = self.mgr.rewrite_writer(rewrites_path, s3, resume.get(rewrites_path))
+            else:
+                second = archived = self.mgr.message_writer(messages_path, s3, resume.get(messages_path))
+            last_id = after
+
+            async def write(data: dict, overlay: dict):
+                nonlocal last_id, count
+                if rewrites is not None:
+                    if overlay:
+                        await rewrites.write_overlay(data["id"], overlay)
+                elif archived is not None:
+                    await archived.write(transcriptreader.with_overlay(data, overlay))
+                await og_msgs.write(data)
+                last_id = int(data["id"])
+                count += 1
+            try:
+                await pipeline.export_channel(channel, write, after)
+                await second.close()
+                await og_msgs.close()
+            except BaseException:
+                await second.abort()
+                await og_msgs.abort()
+                raise
+            await self.mgr.save_json({
+                "last_id": str(last_id),
+                "count": count,
+                "files": {writer.filepath: writer.checkpoint() for writer in (og_msgs, second)},
+                "compression": self.mgr.codec.name if self.mgr.codec is not None else "none",
+            }, checkpoint_path, s3)
+            # so an export that dies later still knows the assets of this channel
+            await self.mgr.index.save(s3)
         except Exception as e:
             log.exception("Failed to build transcript for channel %s", channel.name)
             await self.ctx.channel.send(f"Failed to build transcript for channel {channel.name}: {e}")
@@ -301,6 +684,19 @@ class Transcript:
         # with open("originals.json", "w") as f:
         #     json.dump(og_msgs, f, indent=4, sort_keys=True)
 
+    def matches(self, checkpoint: dict, paths: list) -> bool:
+        """
+            Whether the files checkpoint was written for are still the ones stored, in the same encoding.
+        """
+        codec = self.mgr.codec.name if self.mgr.codec is not None else "none"
+        if checkpoint.get("compression") != codec or set(checkpoint.get("files", {})) != set(paths):
+            return False
+        for path in paths:
+            entry = self.mgr.index.get(path)
+            if entry is None or entry["size"] != checkpoint["files"][path]["size"]:
+                return False
+        return True
+
     async def build(self, s3):
         self.log.info("Building Transcript")
         await self.update_status("Building Transcript")
@@ -308,10 +704,15 @@ class Transcript:
             category_channel = await self.http.get_channel(self.category.id)
             category_json = os.path.join(self.json_folder, "meta.json")
             await self.mgr.save_json(category_channel, category_json, s3)
-            channel_waits = []
-            for channel in self.category.channels:
-                channel_waits.append(self.build_messages(channel, s3))
-            await asyncio.gather(*channel_waits)
+            async with Pipeline(self.mgr, s3) as pipeline:
+                channel_waits = []
+                for channel in self.category.channels:
+                    channel_waits.append(self.build_messages(channel, pipeline, s3))
+                # let the other channels finish (and checkpoint) when one fails
+                results = await asyncio.gather(*channel_waits, return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
         except:
             log.exception("Failed to build transcript")
             await self.update_status("Failed to build transcript!", True)
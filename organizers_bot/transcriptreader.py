@@ -0,0 +1,91 @@
+from . import compression
+from . import jsoncodec
+import argparse
+import copy
+import sys
+import typing
+
+# Reading exported channels, for the archive site. A channel is stored once, as the messages
+# discord sent (messages.orig.json), plus a rewrite map (rewrites.json) of
+# message id -> {dotted path in the message: archived url}, e.g.
+#   {"1002": {"attachments.0.url": "assets/sha1/ab/ab12....png", "attachments.0.proxy_url": "..."}}
+# The archived view, what used to be messages.json, is the messages with the map applied.
+# With the ndjson format both have one item per line, the map as {"id": ..., "rewrites": {...}}.
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def path_key(path: tuple) -> str:
+    return ".".join(str(part) for part in path)
+
+def parse_path(key: str) -> tuple:
+    return tuple(int(part) if part.isdigit() else part for part in key.split("."))
+
+def with_overlay(msg: dict, overlay: dict) -> dict:
+    """
+        msg with the values in overlay (path tuple -> value) replaced. Only the dicts and lists
+        along those paths are copied, the rest is shared with msg.
+    """
+    if not overlay:
+        return msg
+    root = dict(msg)
+    copied: dict[tuple, typing.Any] = {}
+    for path, value in overlay.items():
+        node = root
+        for depth, key in enumerate(path[:-1]):
+            prefix = path[:depth + 1]
+            if prefix not in copied:
+                copied[prefix] = node[key] = copy.copy(node[key])
+            node = copied[prefix]
+        node[path[-1]] = value
+    return root
+
+def decode(data: bytes, encoding: typing.Optional[str] = None) -> bytes:
+    """
+        Stored bytes to JSON. Without the Content-Encoding, e.g. for a downloaded file, it is guessed.
+    """
+    if encoding is None:
+        if data.startswith(GZIP_MAGIC):
+            encoding = "gzip"
+        elif data.startswith(ZSTD_MAGIC):
+            encoding = "zstd"
+    return compression.decompress(data, encoding)
+
+def _lines(data: bytes) -> typing.Iterator:
+    return (jsoncodec.loads(line) for line in data.splitlines() if line.strip())
+
+def read_messages(data: bytes, encoding: typing.Optional[str] = None, ndjson: bool = False) -> list:
+    data = decode(data, encoding)
+    return list(_lines(data)) if ndjson else jsoncodec.loads(data)
+
+def read_rewrites(data: bytes, encoding: typing.Optional[str] = None, ndjson: bool = False) -> dict:
+    """
+        message id -> {path tuple: archived url}
+    """
+    data = decode(data, encoding)
+    if ndjson:
+        entries = ((item["id"], item["rewrites"]) for item in _lines(data))
+    else:
+        entries = jsoncodec.loads(data).items()
+    return {msg_id: {parse_path(key): url for key, url in rewrites.items()} for msg_id, rewrites in entries}
+
+def archived(messages: typing.Iterable[dict], rewrites: dict) -> typing.Iterator[dict]:
+    """
+        The messages as the archive shows them, with the urls of saved contents rewritten.
+    """
+    for msg in messages:
+        yield with_overlay(msg, rewrites.get(msg["id"], {}))
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the archived view (messages.json) of an exported channel.")
+    parser.add_argument("messages", help="messages.orig.json / .ndjson, compressed or not")
+    parser.add_argument("rewrites", help="rewrites.json / .ndjson, compressed or not")
+    args = parser.parse_args()
+    with open(args.messages, "rb") as f:
+        messages = read_messages(f.read(), ndjson=".ndjson" in args.messages)
+    with open(args.rewrites, "rb") as f:
+        rewrites = read_rewrites(f.read(), ndjson=".ndjson" in args.rewrites)
+    sys.stdout.buffer.write(jsoncodec.dumps(list(archived(messages, rewrites))))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+from . import config
+from . import compression
+from . import metrics
+from . import offload
+import aiohttp
+import asyncio
+import contextlib
+import hashlib
+import logging
+import typing
+import uuid
+
+log = logging.getLogger("transfer")
+
+class MemoryBudget:
+    """
+        Caps the bytes buffered by all transfers together. A single request larger than the whole
+        budget still gets through once nothing else is held, so it can't wait forever.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        # created on first use, inside the running loop
+        self.cond: typing.Optional[asyncio.Condition] = None
+
+    @contextlib.asynccontextmanager
+    async def hold(self, amount: int):
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.used == 0 or self.used + amount <= self.limit)
+            self.used += amount
+        try:
+            yield
+        finally:
+            async with self.cond:
+                self.used -= amount
+                self.cond.notify_all()
+
+_budget: typing.Optional[MemoryBudget] = None
+
+def budget() -> MemoryBudget:
+    global _budget
+    if _budget is None:
+        _budget = MemoryBudget(config.s3.memory_budget)
+    return _budget
+
+metrics.Gauge("export_buffered_bytes", "Bytes of assets held in memory by the export", lambda: _budget.used if _budget else 0)
+
+async def read_part(stream: aiohttp.StreamReader, size: int) -> bytes:
+    """
+        The next `size` bytes of stream, fewer only at its end.
+    """
+    try:
+        return await stream.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+def body_size(resp: aiohttp.ClientResponse) -> typing.Optional[int]:
+    """
+        The bytes we will read from resp, if it says. Content-Length counts them before aiohttp decompresses them.
+    """
+    if resp.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    return resp.content_length
+
+def temp_key() -> str:
+    return f"assets/tmp/{uuid.uuid4().hex}"
+
+class Upload:
+    """
+        Multipart upload of a stream of unknown length, hashed while it goes.
+    """
+    def __init__(self, s3, key: str, headers: typing.Optional[dict] = None):
+        self.s3 = s3
+        self.key = key
+        # e.g. ContentType and ContentEncoding of the object
+        self.headers = headers or {}
+        self.sha1 = hashlib.sha1()
+        # False once a part was copied instead of uploaded, sha1 is of the uploaded parts only then
+        self.hashed = True
+        self.size = 0
+        self.parts: list[dict] = []
+        self.upload_id: typing.Optional[str] = None
+
+    async def _start(self):
+        if self.upload_id is None:
+            resp = await self.s3.create_multipart_upload(Bucket=config.s3.bucket_name, Key=self.key, **self.headers)
+            self.upload_id = resp["UploadId"]
+            log.info("Started multipart upload of %s", self.key)
+
+    async def add(self, part: bytes):
+        await self._start()
+        if self.hashed:
+            await offload.sha1_update(self.sha1, part)
+        number = len(self.parts) + 1
+        resp = await self.s3.upload_part(Bucket=config.s3.bucket_name, Key=self.key,
+                PartNumber=number, UploadId=self.upload_id, Body=part)
+        self.parts.append({"ETag": resp["ETag"], "PartNumber": number})
+        self.size += len(part)
+        metrics.export_bytes.inc(amount=len(part))
+
+    async def copy(self, key: str, length: int):
+        """
+            Add the first `length` bytes of the stored object `key` as the next part, copied within s3.
+        """
+        await self._start()
+        number = len(self.parts) + 1
+        resp = await self.s3.upload_part_copy(Bucket=config.s3.bucket_name, Key=self.key,
+                PartNumber=number, UploadId=self.upload_id,
+                CopySource={"Bucket": config.s3.bucket_name, "Key": key}, CopySourceRange=f"bytes=0-{length - 1}")
+        self.parts.append({"ETag": resp["CopyPartResult"]["ETag"], "PartNumber": number})
+        self.size += length
+        self.hashed = False
+
+    async def complete(self) -> dict:
+        """
+            Returns the response with the ETag (and VersionId) of the finished object.
+        """
+        resp = await self.s3.complete_multipart_upload(Bucket=config.s3.bucket_name, Key=self.key,
+                UploadId=self.upload_id, MultipartUpload={"Parts": self.parts})
+        log.info("Finished multipart upload of %s: %d parts, %d bytes", self.key, len(self.parts), self.size)
+        return resp
+
+    async def abort(self):
+        if self.upload_id is None:
+            return
+        try:
+            await self.s3.abort_multipart_upload(Bucket=config.s3.bucket_name, Key=self.key, UploadId=self.upload_id)
+        except Exception:
+            log.exception("Failed to abort multipart upload of %s", self.key)
+
+class StreamWriter:
+    """
+        Writes an object to s3 piece by piece, holding at most one part of it. Full parts go up
+        through a multipart upload; if everything fits in a single part, `small(contents)` saves it instead.
+        With a codec, what is written is compressed on the way, in batches off the event loop.
+    """
+    def __init__(self, s3, key: str, small: typing.Callable[[bytes], typing.Awaitable],
+            codec: typing.Optional[compression.Codec] = None, headers: typing.Optional[dict] = None):
+        self.s3 = s3
+        self.key = key
+        self.small = small
+        self.codec = codec
+        self.headers = headers
+        self.compressor = codec.compressor() if codec is not None else None
+        # written but not compressed yet
+        self.raw = bytearray()
+        # stored bytes waiting to be uploaded
+        self.buf = bytearray()
+        # stored bytes so far, uploaded or not
+        self.size = 0
+        self.upload: typing.Optional[Upload] = None
+
+    async def _flush(self, size: int):
+        if self.upload is None:
+            self.upload = Upload(self.s3, self.key, self.headers)
+        part = bytes(self.buf[:size])
+        del self.buf[:size]
+        async with budget().hold(len(part)):
+            await self.upload.add(part)
+
+    async def _store(self, data: bytes):
+        self.buf += data
+        self.size += len(data)
+        while len(self.buf) >= config.s3.part_size:
+            await self._flush(config.s3.part_size)
+
+    async def _compress(self, compressor):
+        data = bytes(self.raw)
+        self.raw.clear()
+        await self._store(await offload.run_threaded(compressor.compress, data, inline=len(data) < config.offload.min_bytes))
+
+    async def keep(self, length: int, state=None):
+        """
+            Start with the first `length` bytes of what is stored at our key already, cut off where the
+            compressor had `state` (see cut). Must come before any write.
+            S3 only copies parts of at least 5 MiB, anything shorter is downloaded into the buffer instead.
+        """
+        if length <= 0:
+            return
+        if self.codec is not None:
+            self.compressor = self.codec.compressor(state)
+        self.size += length
+        if length >= config.s3.part_size:
+            self.upload = Upload(self.s3, self.key, self.headers)
+            await self.upload.copy(self.key, length)
+            return
+        resp = await self.s3.get_object(Bucket=config.s3.bucket_name, Key=self.key, Range=f"bytes=0-{length - 1}")
+        self.buf += await resp["Body"].read()
+
+    async def write(self, data: bytes):
+        compressor = self.compressor
+        if compressor is None:
+            await self._store(data)
+            return
+        self.raw += data
+        if len(self.raw) >= config.offload.min_bytes:
+            await self._compress(compressor)
+
+    async def cut(self):
+        """
+            Make what is stored so far a point the object can be cut off at, to keep it and append to it later.
+        """
+        compressor = self.compressor
+        if compressor is not None:
+            await self._compress(compressor)
+            await self._store(compressor.cut())
+
+    def state(self):
+        """
+            What keep needs to continue the compressed stream, as of now.
+        """
+        return self.compressor.state() if self.compressor is not None else None
+
+    async def close(self) -> typing.Optional[dict]:
+        """
+            Returns the response of the multipart upload, or None when it was saved by `small`.
+        """
+        compressor = self.compressor
+        if compressor is not None:
+            await self._compress(compressor)
+            await self._store(compressor.flush())
+        if self.upload is None:
+            await self.small(bytes(self.buf))
+            self.buf.clear()
+            return None
+        if self.buf:
+            await self._flush(len(self.buf))
+        return await self.upload.complete()
+
+    async def abort(self):
+        self.raw.clear()
+        self.buf.clear()
+        if self.upload is not None:
+            await self.upload.abort()
@@ -0,0 +1,71 @@
+from . import config
+from . import metrics
+from . import tracing
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+log = logging.getLogger("watchdog")
+
+# recent lag samples in seconds, for the percentiles in /perf
+lags: collections.deque = collections.deque(maxlen=1000)
+# how often the loop was blocked for longer than the threshold
+stalls = 0
+
+async def sample_lag(interval: float):
+    """
+        Measure how much later than scheduled the loop wakes us up.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        lags.append(lag)
+        metrics.loop_lag.observe(lag)
+
+def watch(loop: asyncio.AbstractEventLoop, loop_thread: int, threshold: float, interval: float):
+    """
+        Runs in its own thread: ping the loop, and if it does not answer within `threshold` seconds,
+        log the stack of whatever is running on the loop thread right now. That is the code blocking it.
+    """
+    global stalls
+    while True:
+        answered = threading.Event()
+        start = time.monotonic()
+        loop.call_soon_threadsafe(answered.set)
+        if not answered.wait(threshold):
+            frame = sys._current_frames().get(loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)"
+            stalls += 1
+            answered.wait()
+            log.warning("Event loop blocked for %.2fs, it was running:\n%s", time.monotonic() - start, stack)
+        time.sleep(interval)
+
+def summary() -> tuple:
+    """
+        (samples, p50, p95, p99) of the recent loop lag in seconds
+    """
+    ordered = sorted(lags)
+    if not ordered:
+        return (0, 0.0, 0.0, 0.0)
+    return (len(ordered), tracing.percentile(ordered, 50), tracing.percentile(ordered, 95), tracing.percentile(ordered, 99))
+
+def start(loop: asyncio.AbstractEventLoop):
+    """
+        Start watching `loop`. Must be called from the thread that runs it.
+    """
+    threshold = config.watchdog.threshold
+    if config.watchdog.asyncio_debug:
+        # asyncio then logs every callback/step taking longer than the threshold, naming the coroutine.
+        # Debug mode has some overhead, so it is opt-in.
+        loop.set_debug(True)
+        loop.slow_callback_duration = threshold
+        logging.getLogger("asyncio").setLevel(logging.WARNING)
+    loop.create_task(sample_lag(config.watchdog.interval))
+    threading.Thread(target=watch, name="loop-watchdog", daemon=True,
+            args=(loop, threading.get_ident(), threshold, config.watchdog.interval)).start()
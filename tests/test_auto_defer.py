@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("discord_slash")
+
+from organizers_bot import bot
+
+class FakeContext:
+    """
+        The parts of discord_slash.SlashContext auto_defer relies on.
+    """
+    def __init__(self):
+        self.deferred = False
+        self.responded = False
+        self.calls: list = []
+
+    async def defer(self, hidden: bool = False):
+        await asyncio.sleep(0)
+        self.calls.append(("defer", hidden))
+        self.deferred = True
+
+    async def send(self, content: str = "", files=None, hidden: bool = False):
+        # like discord_slash 1.2.2: files can't go in the first response, so it defers first
+        if files and not self.deferred and not self.responded:
+            await self.defer(hidden=hidden)
+        await asyncio.sleep(0)
+        self.calls.append(("send", content))
+        self.responded = True
+
+def test_files_as_first_response():
+    @bot.auto_defer(budget=10)
+    async def handler(ctx):
+        await ctx.send("here", files=["profile.txt"])
+
+    ctx = FakeContext()
+    asyncio.run(asyncio.wait_for(handler(ctx), 1))
+    assert ctx.calls == [("defer", False), ("send", "here")]
+
+def test_slow_handler_is_deferred_once():
+    @bot.auto_defer(budget=0.01, hidden=True)
+    async def handler(ctx):
+        await asyncio.sleep(0.05)
+        await ctx.send("done")
+
+    ctx = FakeContext()
+    asyncio.run(handler(ctx))
+    assert ctx.calls == [("defer", True), ("send", "done")]
+
+def test_no_defer_after_return():
+    class FailingContext(FakeContext):
+        async def send(self, content: str = "", files=None, hidden: bool = False):
+            await asyncio.sleep(0.05)
+            raise RuntimeError("discord is down")
+
+    @bot.auto_defer(budget=0.01)
+    async def handler(ctx):
+        # the budget runs out while this waits, the automatic defer queues up behind it
+        await ctx.send("never arrives")
+
+    async def run():
+        ctx = FailingContext()
+        with pytest.raises(RuntimeError):
+            await handler(ctx)
+        await asyncio.sleep(0.05)
+        return ctx
+
+    assert asyncio.run(run()).calls == []
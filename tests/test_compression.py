@@ -0,0 +1,52 @@
+import gzip
+import zlib
+
+from organizers_bot import compression
+
+def members(data: bytes) -> int:
+    count = 0
+    while data:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        d.decompress(data)
+        assert d.eof
+        data = d.unused_data
+        count += 1
+    return count
+
+def export(stored: bytes = b"", resume=None, items=(), close=b"]") -> tuple:
+    """
+        What MessageWriter does with its stream: continue at the cut, append, cut, add the trailer, finish.
+    """
+    stream = compression.GzipStream(resume[1] if resume else None)
+    out = stored[:len(stored) - resume[0]] if resume else b""
+    for item in items:
+        out += stream.compress(item)
+    out += stream.cut()
+    state = stream.state()
+    before = len(out)
+    out += stream.compress(close) + stream.flush()
+    return out, (len(out) - before, state)
+
+def test_single_member():
+    out, _ = export(items=[b"[1", b",2"])
+    assert gzip.decompress(out) == b"[1,2]"
+    assert members(out) == 1
+
+def test_resume_continues_the_member():
+    out, resume = export(items=[b"[1", b",2"])
+    out, resume = export(out, resume, [b",3"])
+    out, resume = export(out, resume, [b",4" * 10000])
+    assert gzip.decompress(out) == b"[1,2,3" + b",4" * 10000 + b"]"
+    assert members(out) == 1
+
+def test_resume_without_state_adds_a_member():
+    # checkpoints from before the state was recorded: the stored object ends with a complete member
+    old = gzip.compress(b"[1", mtime=0)
+    out, _ = export(old + gzip.compress(b"]", mtime=0), (len(gzip.compress(b"]", mtime=0)), None), [b",2"])
+    assert compression.decompress(out, "gzip") == b"[1,2]"
+    assert members(out) == 2
+
+def test_whole_object_codec_round_trips():
+    data = b'{"id": "1"}' * 1000
+    for name in compression.codecs:
+        assert compression.decompress(compression.codecs[name].compress(data), name) == data
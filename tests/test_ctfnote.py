@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("gql")
+pytest.importorskip("discord_slash")
+
+from organizers_bot import config
+
+@pytest.fixture
+def ctfnote(monkeypatch):
+    # ctfnote is only imported once the config is loaded
+    monkeypatch.setattr(config, "is_loaded", True)
+    monkeypatch.setattr(config, "ctfnote", config.CtfNoteConfig("http://ctfnote.invalid", "admin", "", False), raising=False)
+    from organizers_bot import ctfnote
+    return ctfnote
+
+def test_concurrent_reads_share_one_request(ctfnote):
+    flights = ctfnote.SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"ctfs": []}
+
+    async def run():
+        results = await asyncio.gather(*[flights.do("key", "ctfs", fetch) for _ in range(3)])
+        # done, the next read sends a new request
+        await flights.do("key", "ctfs", fetch)
+        return results
+
+    results = asyncio.run(run())
+    assert results == [{"ctfs": []}] * 3
+    assert len(calls) == 2
+    assert flights.stats["ctfs"] == {"executed": 2, "collapsed": 2}
+    assert flights.inflight == {}
+
+def test_fresh_read_starts_a_new_request(ctfnote):
+    flights = ctfnote.SingleFlight()
+    calls = []
+
+    async def fetch():
+        # each request answers with its own number
+        calls.append(len(calls))
+        number = calls[-1]
+        await asyncio.sleep(0.01)
+        return number
+
+    async def run():
+        first = asyncio.ensure_future(flights.do("key", "tasks", fetch))
+        await asyncio.sleep(0)
+        return await asyncio.gather(first, flights.do("key", "tasks", fetch, fresh=True), flights.do("key", "tasks", fetch))
+
+    # the caller after the fresh one joins the fresh request
+    assert asyncio.run(run()) == [0, 1, 1]
+    assert flights.stats["tasks"] == {"executed": 2, "collapsed": 1}
+
+def test_cancelled_caller_does_not_cancel_the_others(ctfnote):
+    flights = ctfnote.SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "me"
+
+    async def run():
+        impatient = asyncio.ensure_future(flights.do("key", "me", fetch))
+        patient = asyncio.ensure_future(flights.do("key", "me", fetch))
+        await asyncio.sleep(0.005)
+        impatient.cancel()
+        return await patient
+
+    assert asyncio.run(run()) == "me"
@@ -0,0 +1,62 @@
+import copy
+
+import pytest
+
+discord = pytest.importorskip("discord")
+
+from organizers_bot import config
+from organizers_bot import guildindex
+
+def make(cls, id: int, name: str, category_id=None, position: int = 0):
+    # bare channels, without the connection state discord.py would give them
+    channel = cls.__new__(cls)
+    channel.id = id
+    channel.name = name
+    channel.category_id = category_id
+    channel.position = position
+    return channel
+
+def update(index: guildindex.GuildIndex, channel, **changes):
+    # like discord.py: `before` is a copy, the cached channel itself is changed in place
+    before = copy.copy(channel)
+    for attr, value in changes.items():
+        setattr(channel, attr, value)
+    index.update(before, channel)
+
+@pytest.fixture
+def index(monkeypatch):
+    monkeypatch.setattr(config, "mgmt", config.ManagementConfig(["web", "pwn"], 0, 0, 0, ""), raising=False)
+    index = guildindex.GuildIndex()
+    index.web = make(discord.CategoryChannel, 1, "web")
+    index.pwn = make(discord.CategoryChannel, 2, "pwn")
+    index.chall = make(discord.TextChannel, 10, "xss", category_id=1)
+    for channel in (index.web, index.pwn, index.chall):
+        index.add(channel)
+    return index
+
+def test_move(index):
+    update(index, index.chall, category_id=2)
+    assert index.channels_in(index.web) == []
+    assert index.channels_in(index.pwn) == [index.chall]
+    assert index.challenge(10).category == "pwn"
+
+def test_rename(index):
+    update(index, index.chall, name=guildindex.SOLVED_PREFIX + "xss")
+    assert index.channels_in(index.web) == [index.chall]
+    assert index.challenge(10).name == "xss"
+    assert index.challenge(10).solved
+
+def test_rename_category(index):
+    update(index, index.web, name="pwn-old")
+    assert index.category("web") is None
+    assert index.category("pwn-old") is index.web
+    # no longer a challenge category
+    assert 10 not in index.challenges
+    assert index.challenge_channels() == []
+
+def test_remove_after_move(index):
+    update(index, index.chall, category_id=2)
+    index.remove(index.chall)
+    assert index.channels_in(index.web) == []
+    assert index.channels_in(index.pwn) == []
+    assert index.channel_count == 2
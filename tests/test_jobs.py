@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("discord")
+
+from organizers_bot import jobs
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def drain(queue: jobs.JobQueue):
+    while queue.depth:
+        await asyncio.sleep(0.005)
+
+def test_chain_runs_in_order():
+    async def main():
+        queue = jobs.JobQueue("test", backoff=0.01)
+        events = []
+
+        async def job(name, delay):
+            events.append(("start", name))
+            await asyncio.sleep(delay)
+            events.append(("end", name))
+
+        queue.submit(("add_task", 1), "add", lambda: job("add", 0.02), chain=1)
+        queue.submit(("update_flag", 1), "flag", lambda: job("flag", 0), chain=1)
+        await drain(queue)
+        return events
+
+    assert run(main()) == [("start", "add"), ("end", "add"), ("start", "flag"), ("end", "flag")]
+
+def test_dedup_replaces_waiting_job():
+    async def main():
+        queue = jobs.JobQueue("test")
+        ran = []
+
+        async def job(value):
+            ran.append(value)
+            await asyncio.sleep(0.01)
+
+        queue.submit("first", "first", lambda: job("first"), chain=1)
+        queue.submit("flag", "flag", lambda: job(1), chain=1)
+        replaced = not queue.submit("flag", "flag", lambda: job(2), chain=1)
+        await drain(queue)
+        return replaced, ran
+
+    assert run(main()) == (True, ["first", 2])
+
+def test_retry_holds_up_the_chain():
+    async def main():
+        queue = jobs.JobQueue("test", backoff=0.01)
+        events = []
+        failures = [RuntimeError("ctfnote is down")] * 2
+
+        async def flaky():
+            if failures:
+                raise failures.pop()
+            events.append("add")
+
+        async def flag():
+            events.append("flag")
+
+        async def other():
+            events.append("other")
+
+        queue.submit("add", "add", flaky, chain=1)
+        queue.submit("flag", "flag", flag, chain=1)
+        queue.submit("other", "other", other, chain=2)
+        await drain(queue)
+        return events
+
+    events = run(main())
+    assert events.index("add") < events.index("flag")
+    assert sorted(events) == ["add", "flag", "other"]
+
+def test_gives_up_and_reports():
+    class Channel:
+        def __init__(self):
+            self.sent = []
+
+        async def send(self, msg):
+            self.sent.append(msg)
+
+    async def main():
+        queue = jobs.JobQueue("test", attempts=2, backoff=0.01)
+        channel = Channel()
+
+        async def broken():
+            raise RuntimeError("nope")
+
+        queue.submit("job", "do the thing", broken, channel=channel)
+        await drain(queue)
+        return channel.sent
+
+    assert run(main()) == ["Failed to do the thing: nope"]
@@ -0,0 +1,60 @@
+import asyncio
+
+from organizers_bot import serial
+
+def test_same_key_runs_in_order():
+    executor = serial.KeyedExecutor("test")
+    events = []
+
+    async def work(key, name, delay):
+        async with executor.hold(key):
+            events.append(("start", name))
+            await asyncio.sleep(delay)
+            events.append(("end", name))
+
+    async def run():
+        await asyncio.gather(work("a", 1, 0.02), work("a", 2, 0), work("a", 3, 0))
+
+    asyncio.run(run())
+    assert events == [("start", 1), ("end", 1), ("start", 2), ("end", 2), ("start", 3), ("end", 3)]
+
+def test_different_keys_run_concurrently():
+    executor = serial.KeyedExecutor("test")
+    running = set()
+    overlapped = []
+
+    async def work(key):
+        async with executor.hold(key):
+            running.add(key)
+            await asyncio.sleep(0.01)
+            overlapped.append(len(running))
+            running.discard(key)
+
+    async def run():
+        await asyncio.gather(work("a"), work("b"))
+
+    asyncio.run(run())
+    assert max(overlapped) == 2
+
+def test_busy_keys_are_forgotten_when_idle():
+    executor = serial.KeyedExecutor("test")
+    seen = {}
+
+    async def run():
+        release = asyncio.Event()
+
+        async def hold():
+            async with executor.hold(("channel", 1)):
+                await release.wait()
+
+        tasks = [asyncio.create_task(hold()) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        seen.update(executor.busy())
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    depth, runs, _ = seen["channel 1"]
+    assert (depth, runs) == (2, 1)
+    assert executor.busy() == {}
+    assert not executor.locks and not executor.stats and not executor.depth
@@ -0,0 +1,66 @@
+from organizers_bot import compression
+from organizers_bot import jsoncodec
+from organizers_bot import transcriptreader
+
+MESSAGES = [
+    {"id": "1001", "content": "hi", "attachments": []},
+    {"id": "1002", "content": "flag.png", "author": {"id": "7", "avatar_url": "https://cdn.discordapp.com/avatars/7/a.png"},
+        "attachments": [{"url": "https://cdn.discordapp.com/1.png", "proxy_url": "https://media.discordapp.net/1.png"}]},
+]
+OVERLAYS = {
+    "1002": {
+        ("author", "avatar_url"): "assets/avatars/7/a.png",
+        ("attachments", 0, "url"): "assets/sha1/ab/ab12.png",
+        ("attachments", 0, "proxy_url"): "assets/sha1/ab/ab12.png",
+    },
+}
+
+def store(items: list, ndjson: bool, gzip: bool, open_: bytes = b"[", close: bytes = b"]") -> bytes:
+    """
+        What the writers store: encoded items as a JSON array/object or NDJSON, streamed through gzip.
+    """
+    if ndjson:
+        data = b"".join(item + b"\n" for item in items)
+    else:
+        data = open_ + b",".join(items) + close
+    if not gzip:
+        return data
+    stream = compression.GzipStream()
+    return stream.compress(data) + stream.flush()
+
+def store_rewrites(ndjson: bool, gzip: bool) -> bytes:
+    # like RewriteWriter.write_overlay
+    items = []
+    for msg_id, overlay in OVERLAYS.items():
+        rewrites = {transcriptreader.path_key(path): url for path, url in overlay.items()}
+        if ndjson:
+            items.append(jsoncodec.dumps({"id": msg_id, "rewrites": rewrites}))
+        else:
+            items.append(jsoncodec.dumps(msg_id) + b":" + jsoncodec.dumps(rewrites))
+    return store(items, ndjson, gzip, b"{", b"}")
+
+def test_with_overlay_copies_only_the_changed_paths():
+    msg = MESSAGES[1]
+    out = transcriptreader.with_overlay(msg, OVERLAYS["1002"])
+    assert out["attachments"][0] == {"url": "assets/sha1/ab/ab12.png", "proxy_url": "assets/sha1/ab/ab12.png"}
+    assert out["author"] == {"id": "7", "avatar_url": "assets/avatars/7/a.png"}
+    # the original is untouched
+    assert msg["attachments"][0]["url"] == "https://cdn.discordapp.com/1.png"
+    assert msg["author"]["avatar_url"].startswith("https://")
+    assert transcriptreader.with_overlay(MESSAGES[0], {}) is MESSAGES[0]
+
+def test_round_trip():
+    for ndjson in (False, True):
+        for gzip in (False, True):
+            messages = transcriptreader.read_messages(store([jsoncodec.dumps(msg) for msg in MESSAGES], ndjson, gzip), ndjson=ndjson)
+            rewrites = transcriptreader.read_rewrites(store_rewrites(ndjson, gzip), ndjson=ndjson)
+            assert messages == MESSAGES
+            assert rewrites == OVERLAYS
+            view = list(transcriptreader.archived(messages, rewrites))
+            assert view[0] == MESSAGES[0]
+            assert view[1]["attachments"][0]["url"] == "assets/sha1/ab/ab12.png"
+            assert view[1]["author"]["avatar_url"] == "assets/avatars/7/a.png"
+
+def test_round_trip_with_content_encoding():
+    data = store([jsoncodec.dumps(msg) for msg in MESSAGES], False, True)
+    assert transcriptreader.read_messages(data, "gzip") == MESSAGES